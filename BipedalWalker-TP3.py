@@ -1,17 +1,36 @@
 import click
 from collections import namedtuple
+import functools
 import gym
+import multiprocessing
 import numpy as np
 import os
 import pickle
+import queue
 import random
+import signal
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.distributions import Normal
+
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, mean_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import autocast, compile_learner, warmup_learner
+from noise_pool import NoisePool
+from policy_compression import quantize_policy, quantize_agent, distill_agent
+from learner_thread import LearnerThread
+from action_repeat import ActionRepeat
 
 SAVE_FILE_PATH = "BipedalWalker-TP3.torch"
+EXPORT_FILE_PATH = "BipedalWalker-TP3.npz"
+QUANTIZED_FILE_PATH = "BipedalWalker-TP3-int8.torch"
+STUDENT_FILE_PATH = "BipedalWalker-TP3-student.torch"
+SHARED_WEIGHTS_NAME = "BipedalWalker-TP3-weights"
 
 # if gpu is used
 device = ("cuda" if torch.cuda.is_available() else "cpu")
@@ -34,6 +53,21 @@ class Policy(nn.Module):
         x = F.relu(self.h2(x))
         return torch.tanh(self.pi(x))
 
+class Student(nn.Module):
+
+    HIDDEN_LAYER_SIZE = 64
+
+    def __init__(self, inputs, outputs):
+        super(Student, self).__init__()
+
+        self.h1 = nn.Linear(inputs, self.HIDDEN_LAYER_SIZE)
+        self.pi = nn.Linear(self.HIDDEN_LAYER_SIZE, outputs)
+
+    def forward(self, x):
+
+        x = F.relu(self.h1(x))
+        return torch.tanh(self.pi(x))
+
 class Q(nn.Module):
 
     HIDDEN_LAYER_SIZE_1 = 512
@@ -50,9 +84,7 @@ class Q(nn.Module):
 
     def forward(self, x, a):
 
-
-        for i in range(self.actions):
-            x = torch.cat((x, a[i]), 1)
+        x = torch.cat((x, a), 1)
 
         x = F.relu(self.h1(x))
         x = F.relu(self.h2(x))
@@ -77,10 +109,11 @@ class TP3:
     update = 0
     noise = NOISE_START
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, bf16=False, compile=False):
 
         self.outputs = outputs
         self.inputs = inputs
+        self.bf16 = bf16
 
         self.q1 = Q(inputs, outputs).to(device)
         self.q2 = Q(inputs, outputs).to(device)
@@ -101,24 +134,39 @@ class TP3:
 
         self.optimizer_pi = optim.Adam(self.pi.parameters(), lr=self.ALPHA)
 
-    def action(self, s, use_noise=False):
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(1, inputs, device=device)
 
-        with torch.no_grad():
-            pi = self.pi(torch.as_tensor(s).float().to(device)).cpu()
+        # Exploration noise drawn by blocks, scaled by the current level
+        self.noise_pool = NoisePool(outputs)
+
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
+
+        self.learner_q = compile_learner(self.learn_q) if compile else self.learn_q
+        self.learner_pi = compile_learner(self.learn_pi) if compile else self.learn_pi
+        self.warm = not compile
+
+    def action(self, s, use_noise=False, pi=None):
+
+        # Another copy of the policy can be given, the snapshot of the
+        # learner thread for instance
+        if pi is None:
+            pi = self.pi
+
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+            a = pi(self.input_buffer).cpu().numpy()[0]
 
         if use_noise:
 
-            pi = Normal(pi, self.noise).sample()
+            a += self.noise_pool.sample(self.noise)
 
             if self.noise > self.NOISE_MIN:
                 self.noise -= self.NOISE_DECAY
 
-        a = []
-
-        for i in range(self.outputs):
-            a.append(pi[i].clamp(-1.0, 1.0))
-
-        return a
+        return np.clip(a, -1.0, 1.0, out=a)
 
     def store(self, *args):
 
@@ -128,107 +176,122 @@ class TP3:
         if len(self.memory) > self.MEMORY_SIZE:
             self.memory.pop(0)
 
+    def store_batch(self, transitions):
+
+        self.memory.extend(self.experience(*transition) for transition in transitions)
+
+        if len(self.memory) > self.MEMORY_SIZE:
+            del self.memory[:len(self.memory) - int(self.MEMORY_SIZE)]
+
     def train(self):
 
+        # Tell the learner thread whether the networks were updated
         if len(self.memory) < self.BATCH_SIZE:
-            return
+            return False
 
         samples = random.sample(self.memory, self.BATCH_SIZE)
         batch = self.experience(*zip(*samples))
 
         states = torch.as_tensor(np.float32(batch.s), device=device)
         next_states = torch.as_tensor(np.float32(batch.s2), device=device)
-        rewards = torch.as_tensor(batch.r, device=device)
-        done = torch.as_tensor(batch.done, device=device)
-        y = torch.zeros([self.BATCH_SIZE, 1], device=device)
-        actions = torch.zeros([self.outputs, self.BATCH_SIZE, 1], device=device)
+        actions = torch.as_tensor(np.float32(batch.a), device=device)
+        rewards = torch.as_tensor(np.float32(batch.r), device=device).view(-1, 1)
+        done = torch.as_tensor(np.float32(batch.done), device=device).view(-1, 1)
 
-        for i in range(self.BATCH_SIZE):
-            for j in range(self.outputs):
-                actions[j][i] = batch.a[i][j]
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: (
+                self.learner_q(states, next_states, actions, rewards, done),
+                self.learner_pi(states)))
+            self.warm = True
 
-        q1 = self.q1(states, actions)
-        q2 = self.q2(states, actions)
+        self.learner_q(states, next_states, actions, rewards, done)
 
-        with torch.no_grad():
+        # Delayed Policy Updates
+        self.update += 1
+        if self.update % 2 == 0:
+            return True
+
+        self.learner_pi(states)
+
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
+
+        return True
+
+    def learn_q(self, states, next_states, actions, rewards, done):
 
-            next_pi_actions = torch.zeros([self.outputs, self.BATCH_SIZE, 1], device=device)
+        with autocast(self.bf16):
+            q1 = self.q1(states, actions).float()
+            q2 = self.q2(states, actions).float()
+
+        with torch.no_grad(), autocast(self.bf16):
 
             next_pi = self.pi_target(next_states)
 
-            noise = torch.FloatTensor(batch.a).data.normal_(0, self.NOISE_MIN).to(device)
+            noise = torch.empty_like(actions).normal_(0, self.NOISE_MIN)
             noise = noise.clamp(-self.NOISE_CLIP, self.NOISE_CLIP)
 
             # Target Policy Smoothing
-            for i in range(self.BATCH_SIZE):
-                for j in range(self.outputs):
-                    next_pi_actions[j][i] = (next_pi[i][j] + noise[i][j]).clamp(-1.0, 1.0)
+            next_pi_actions = (next_pi + noise).clamp(-1.0, 1.0)
 
             next_q1 = self.q1_target(next_states, next_pi_actions)
             next_q2 = self.q2_target(next_states, next_pi_actions)
 
-            next_q = torch.min(next_q1, next_q2)
-
-            for i in range(self.BATCH_SIZE):
+            next_q = torch.min(next_q1, next_q2).float()
 
-                if done[i]:
-                    y[i] = rewards[i]
-                else:
-                    y[i] = rewards[i] + self.GAMMA * next_q[i]
+            y = rewards + self.GAMMA * next_q * (1.0 - done)
 
         q1_loss = torch.nn.MSELoss()(q1, y)
         q2_loss = torch.nn.MSELoss()(q2, y)
 
+        # The critics don't share any parameter, a single backward through
+        # both losses gives each one its own gradients
         self.optimizer_q1.zero_grad()
-        q1_loss.backward()
-        self.optimizer_q1.step()
-
         self.optimizer_q2.zero_grad()
-        q2_loss.backward()
+        (q1_loss + q2_loss).backward()
+        self.optimizer_q1.step()
         self.optimizer_q2.step()
 
-        # Delayed Policy Updates
-        self.update += 1
-        if self.update % 2 == 0:
-            return
-
-        pi = self.pi(states)
-
-        pi_actions = torch.zeros([self.outputs, self.BATCH_SIZE, 1], device=device)
+    def learn_pi(self, states):
 
-        # Target Policy Smoothing
-        for i in range(self.BATCH_SIZE):
-            for j in range(self.outputs):
-                pi_actions[j][i] = pi[i][j]
-
-        pi_loss = - self.q1(states, pi_actions).mean()
+        with autocast(self.bf16):
+            pi_loss = - self.q1(states, self.pi(states)).float().mean()
 
         self.optimizer_pi.zero_grad()
         pi_loss.backward()
         self.optimizer_pi.step()
 
         # Update target network
-        for target_param, source_param in zip(self.q1_target.parameters(), self.q1.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+        with torch.no_grad():
+
+            for target_param, source_param in zip(self.q1_target.parameters(), self.q1.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-        for target_param, source_param in zip(self.q2_target.parameters(), self.q2.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+            for target_param, source_param in zip(self.q2_target.parameters(), self.q2.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-        for target_param, source_param in zip(self.pi_target.parameters(), self.pi.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+            for target_param, source_param in zip(self.pi_target.parameters(), self.pi.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-def play_agent(env, agent):
+def play_agent(env, agent, weights=None, limit=0):
 
     results = []
     episode = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episode < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         rewards = 0
         s = env.reset()
@@ -251,10 +314,12 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = []
+    total_steps = 0
+    start = time.perf_counter()
 
     while 1:
 
@@ -271,6 +336,8 @@ def train_agent(env, agent):
             agent.store(s, s2, r, a, done)
             agent.train()
 
+            total_steps += 1
+
             s = s2
 
             if done:
@@ -282,14 +349,12 @@ def train_agent(env, agent):
 
                 score = np.mean(np.asarray(results))
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score >= 200:
-                    torch.save((
-                        agent.q1.state_dict(), \
-                        agent.q1_target.state_dict(), \
-                        agent.q2.state_dict(), \
-                        agent.q2_target.state_dict(), \
-                        agent.pi.state_dict(), \
-                        agent.pi_target.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
                     print("Finished!!!")
                     exit()
 
@@ -297,28 +362,350 @@ def train_agent(env, agent):
 
                 print("Episode", episode,
                       "rewards", rewards,
-                      "score", score)
+                      "score", score,
+                      "steps/s", round(total_steps / (time.perf_counter() - start), 1))
 
                 # Save the state of the agent
                 if episode % 20 == 0:
-                    torch.save((
-                        agent.q1.state_dict(), \
-                        agent.q1_target.state_dict(), \
-                        agent.q2.state_dict(), \
-                        agent.q2_target.state_dict(), \
-                        agent.pi.state_dict(), \
-                        agent.pi_target.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
 
                 break
 
+def train_threaded_agent(env, agent, update_ratio):
+
+    episode = 0
+    results = []
+    total_steps = 0
+    start = time.perf_counter()
+
+    # The updates run in their own thread, at most update_ratio per step
+    learner = LearnerThread(agent, agent.pi, update_ratio)
+
+    while 1:
+
+        rewards = 0
+        lags = []
+        s = env.reset()
+
+        while 1:
+
+            # Act with the newest snapshot of the policy
+            a, lag = learner.act(lambda pi: agent.action(s, True, pi))
+            lags.append(lag)
+            s2, r, done, _ = env.step(a)
+
+            rewards += r
+
+            learner.store(s, s2, r, a, done)
+
+            total_steps += 1
+
+            s = s2
+
+            if done:
+
+                # Calcul the score total over 100 episodes
+                results.append(rewards)
+                if len(results) > 100:
+                    results.pop(0)
+
+                score = np.mean(np.asarray(results))
+
+                if score >= 200:
+                    with learner.lock:
+                        save_agent(agent)
+                    print("Finished!!!")
+                    exit()
+
+                episode += 1
+
+                print("Episode", episode,
+                      "rewards", rewards,
+                      "score", score,
+                      "steps/s", round(total_steps / (time.perf_counter() - start), 1),
+                      "updates/s", round(learner.updates / (time.perf_counter() - start), 1),
+                      "policy lag", round(np.mean(lags), 1))
+
+                # Save the state of the agent
+                if episode % 20 == 0:
+                    with learner.lock:
+                        save_agent(agent)
+
+                break
+
+def run_worker(index, noise, repeat, transitions, stop):
+
+    WORKER_CHUNK = 100
+
+    # Each worker acts on a single core, the learner keeps the others
+    torch.set_num_threads(1)
+
+    # The learner handles ctrl-c and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    env = gym.make('BipedalWalker-v3')
+
+    if repeat > 1:
+        env = ActionRepeat(env, repeat)
+
+    pi = Policy(env.observation_space.shape[0], env.action_space.shape[0])
+    weights = WeightSubscriber(SHARED_WEIGHTS_NAME, pi)
+    noise_pool = NoisePool(env.action_space.shape[0])
+
+    chunk = []
+    steps = 0
+    start = time.perf_counter()
+
+    while not stop.is_set():
+
+        rewards = 0
+        s = env.reset()
+
+        while 1:
+
+            # Follow the weights broadcast by the learner
+            weights.poll()
+
+            with torch.inference_mode():
+                a = pi(torch.as_tensor(s).unsqueeze(0)).numpy()[0]
+
+            a = np.clip(a + noise_pool.sample(noise), -1.0, 1.0)
+            s2, r, done, _ = env.step(a)
+
+            chunk.append((s, s2, r, a, done))
+            rewards += r
+            steps += 1
+
+            s = s2
+
+            # The transitions are sent by chunks to amortize the pickling
+            if len(chunk) == WORKER_CHUNK:
+                transitions.put(("transitions", index, chunk, steps / (time.perf_counter() - start)))
+                chunk = []
+
+            if done:
+                transitions.put(("episode", index, rewards, weights.version))
+                break
+
+    weights.close()
+
+def train_worker_agent(env, agent, workers, repeat):
+
+    BROADCAST_UPDATES = 10
+
+    # The learner broadcasts the policy through the shared weights, every
+    # publish updates if set or every BROADCAST_UPDATES updates
+    if not agent.publisher:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, BROADCAST_UPDATES)
+
+    # Every worker explores with its own fixed noise, from the start noise
+    # for the first one down to the min noise for the last one
+    noises = [agent.NOISE_START * (agent.NOISE_MIN / agent.NOISE_START) ** (i / max(workers - 1, 1))
+              for i in range(workers)]
+
+    context = multiprocessing.get_context("spawn")
+    transitions = context.Queue()
+    stop = context.Event()
+
+    processes = [context.Process(target=run_worker, args=(i, noises[i], repeat, transitions, stop), daemon=True)
+                 for i in range(workers)]
+
+    for process in processes:
+        process.start()
+
+    episode = 0
+    results = []
+    steps_per_second = [0.0] * workers
+    updates = 0
+    start = time.perf_counter()
+
+    try:
+        while 1:
+
+            # Wait for the first transitions, then take all the messages
+            # that arrived since the last update
+            messages = [transitions.get()] if len(agent.memory) < agent.BATCH_SIZE else []
+
+            while 1:
+                try:
+                    messages.append(transitions.get_nowait())
+                except queue.Empty:
+                    break
+
+            for message in messages:
+
+                if message[0] == "transitions":
+                    _, index, chunk, steps_per_second[index] = message
+                    agent.store_batch(chunk)
+                    continue
+
+                _, index, rewards, version = message
+
+                # Calcul the score total over 100 episodes of all the workers
+                results.append(rewards)
+                if len(results) > 100:
+                    results.pop(0)
+
+                score = np.mean(np.asarray(results))
+
+                if score >= 200:
+                    save_agent(agent)
+                    print("Finished!!!")
+                    return
+
+                episode += 1
+
+                print("Episode", episode,
+                      "worker", index,
+                      "rewards", rewards,
+                      "score", score,
+                      "weights version", version,
+                      "updates/s", round(updates / (time.perf_counter() - start), 1),
+                      "steps/s per worker", [round(steps) for steps in steps_per_second],
+                      "total", round(sum(steps_per_second), 1))
+
+                # Save the state of the agent
+                if episode % 20 == 0:
+                    save_agent(agent)
+
+            if len(agent.memory) >= agent.BATCH_SIZE:
+                agent.train()
+                updates += 1
+
+    finally:
+        stop.set()
+
+        for process in processes:
+            process.terminate()
+            process.join()
+
+def benchmark_agent(env):
+
+    BENCH_TRANSITIONS = 1000
+    BENCH_UPDATES = 200
+    BENCH_ACTIONS = 10000
+
+    # Record random transitions shared by both precisions
+    s = env.reset()
+
+    for i in range(BENCH_TRANSITIONS):
+
+        a = env.action_space.sample().tolist()
+        s2, r, done, _ = env.step(a)
+
+        TP3.memory.append(TP3.experience(s, s2, r, a, done))
+
+        s = s2
+
+        if done:
+            s = env.reset()
+
+    for bf16 in [False, True]:
+
+        agent = TP3(env.observation_space.shape[0], env.action_space.shape[0], bf16)
+
+        # Warm up before timing
+        for i in range(10):
+            agent.train()
+
+        start = time.perf_counter()
+        for i in range(BENCH_UPDATES):
+            agent.train()
+        elapsed = time.perf_counter() - start
+
+        print("Precision", "bfloat16" if bf16 else "float32",
+              "updates/s", round(BENCH_UPDATES / elapsed, 1))
+
+    # Time the actions with the exploration noise as during the training
+    agent = TP3(env.observation_space.shape[0], env.action_space.shape[0])
+    states = [experience.s for experience in TP3.memory]
+
+    # Warm up before timing
+    for i in range(100):
+        agent.action(states[i], True)
+
+    start = time.perf_counter()
+    for i in range(BENCH_ACTIONS):
+        agent.action(states[i % len(states)], True)
+    elapsed = time.perf_counter() - start
+
+    print("Action latency", round(elapsed / BENCH_ACTIONS * 1e6, 1), "us")
+
+def save_agent(agent):
+
+    torch.save((
+        agent.q1.state_dict(), \
+        agent.q1_target.state_dict(), \
+        agent.q2.state_dict(), \
+        agent.q2_target.state_dict(), \
+        agent.pi.state_dict(), \
+        agent.pi_target.state_dict()), SAVE_FILE_PATH)
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    program = [
+        ("linear", dict(agent.pi.h1.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(agent.pi.h2.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(agent.pi.pi.named_parameters())),
+        ("tanh", {}),
+        ("clip", {"low": -1.0, "high": 1.0})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            expected = agent.pi(torch.as_tensor(np.float32(s), device=device))
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, EXPORT_FILE_PATH, QUANTIZED_FILE_PATH, STUDENT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--quantize', flag_value='quantize', default=False)
+@click.option('--distill', flag_value='distill', default=False)
+@click.option('--bf16', is_flag=True, default=False)
+@click.option('--int8', is_flag=True, default=False)
+@click.option('--student', is_flag=True, default=False)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--workers', type=int, default=0)
+@click.option('--repeat', type=int, default=1)
+@click.option('--threaded', is_flag=True, default=False)
+@click.option('--update-ratio', type=float, default=1.0)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, quantize, distill, bf16, int8, student, compile, publish, follow, workers, repeat, threaded, update_ratio, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -327,8 +714,22 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('BipedalWalker-v3')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    # Repeat each action for repeat ticks of the simulator
+    if repeat > 1:
+        env = ActionRepeat(env, repeat, render=bool(play))
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = TP3(env.observation_space.shape[0], env.action_space.shape[0])
+    agent = TP3(env.observation_space.shape[0], env.action_space.shape[0], bf16, compile)
+
+    loaded = False
 
     try:
         q1, q1_target, q2, q2_target, pi, pi_target = torch.load(SAVE_FILE_PATH)
@@ -338,17 +739,76 @@ def run(play, train, clean):
         agent.q2_target.load_state_dict(q2_target)
         agent.pi.load_state_dict(pi)
         agent.pi_target.load_state_dict(pi_target)
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        agent.q1.eval()
-        agent.q2.eval()
-        agent.pi.eval()
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and (export or quantize or distill):
+        raise click.ClickException("No agent saved in %s, train one first" % SAVE_FILE_PATH)
+
+    # Play with the int8 policy saved by --quantize
+    if int8:
+        agent.pi = quantize_policy(agent.pi)
+        agent.pi.load_state_dict(torch.load(QUANTIZED_FILE_PATH))
+        agent.input_buffer = agent.input_buffer.cpu()
+
+    # Play with the student saved by --distill
+    if student:
+        agent.pi = Student(env.observation_space.shape[0], env.action_space.shape[0]).to(device)
+        agent.pi.load_state_dict(torch.load(STUDENT_FILE_PATH))
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, publish)
+
+    try:
+        if play:
+            agent.q1.eval()
+            agent.q2.eval()
+            agent.pi.eval()
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.pi) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.pi, mean_action, evaluate,
+                wrapper=functools.partial(ActionRepeat, repeat=repeat) if repeat > 1 else None)
+        elif serve:
+            serve_agent(env, agent.pi, lambda a: a, serve)
+        elif quantize:
+            quantize_agent(env, agent, QUANTIZED_FILE_PATH)
+        elif distill:
+            distill_agent(env, agent.pi, Student(agent.inputs, agent.outputs).to(device), STUDENT_FILE_PATH)
+        elif train and workers:
+            train_worker_agent(env, agent, workers, repeat)
+        elif train and threaded:
+            train_threaded_agent(env, agent, update_ratio)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.pi, mean_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "return", -np.inf,
+                    wrapper=functools.partial(ActionRepeat, repeat=repeat) if repeat > 1 else None)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
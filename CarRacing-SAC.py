@@ -1,21 +1,49 @@
 import click
 from collections import namedtuple
+import functools
 import gym
 import numpy as np
 import os
 import pickle
 import random
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.distributions import Normal
 
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, mean_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import autocast, compile_learner, warmup_learner
+from noise_pool import NoisePool
+from policy_compression import quantize_policy, quantize_agent, distill_agent
+from env_pool import EnvPool
+from frame_preprocessor import FramePreprocessor
+from action_repeat import ActionRepeat
+
 SAVE_FILE_PATH = "CarRacing-SAC.torch"
+EXPORT_FILE_PATH = "CarRacing-SAC.npz"
+QUANTIZED_FILE_PATH = "CarRacing-SAC-int8.torch"
+STUDENT_FILE_PATH = "CarRacing-SAC-student.torch"
+SHARED_WEIGHTS_NAME = "CarRacing-SAC-weights"
+
+# Rows of the HUD bar at the bottom of the frames. Cropping them or
+# downsampling the frames changes the inputs of the networks, a saved agent
+# only loads with the values it was trained with
+HUD_HEIGHT = 12
+CROP_HUD = False
+DOWNSAMPLE = 1
 
 # if gpu is used
 device = ("cuda" if torch.cuda.is_available() else "cpu")
 
+# Greyscale uint8 frames given to the networks
+preprocess = FramePreprocessor(HUD_HEIGHT if CROP_HUD else 0, DOWNSAMPLE)
+
 class Policy(nn.Module):
 
     HIDDEN_LAYER_SIZE_1 = 512
@@ -38,6 +66,26 @@ class Policy(nn.Module):
         x = F.relu(self.h2(x))
         return torch.tanh(self.pi(x))
 
+class Student(nn.Module):
+
+    HIDDEN_LAYER_SIZE = 32
+
+    def __init__(self, inputs2D, outputs):
+        super(Student, self).__init__()
+
+        self.inputs1D = inputs2D[0] * inputs2D[1]
+
+        self.h1 = nn.Linear(self.inputs1D, self.HIDDEN_LAYER_SIZE)
+        self.pi = nn.Linear(self.HIDDEN_LAYER_SIZE, outputs)
+
+    def forward(self, x):
+
+        # The pixels are scaled to [0, 1] to keep the small layer trainable
+        x = x.view(-1, self.inputs1D) / 255.0
+
+        x = F.relu(self.h1(x))
+        return torch.tanh(self.pi(x))
+
 class Q(nn.Module):
 
     HIDDEN_LAYER_SIZE_1 = 512
@@ -56,9 +104,7 @@ class Q(nn.Module):
     def forward(self, x, a):
 
         x = x.view(-1, self.inputs1D)
-
-        for i in range(self.actions):
-            x = torch.cat((x, a[i]), 1)
+        x = torch.cat((x, a), 1)
 
         x = F.relu(self.h1(x))
         x = F.relu(self.h2(x))
@@ -83,10 +129,11 @@ class SAC:
     update = 0
     noise = NOISE_START
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, bf16=False, compile=False):
 
         self.outputs = outputs
         self.inputs = inputs
+        self.bf16 = bf16
 
         self.q1 = Q(inputs, outputs).to(device)
         self.q2 = Q(inputs, outputs).to(device)
@@ -103,25 +150,49 @@ class SAC:
         self.pi = Policy(inputs, outputs).to(device)
         self.optimizer_pi = optim.Adam(self.pi.parameters(), lr=self.LR)
 
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros([1] + inputs, device=device)
+
+        # Exploration noise drawn by blocks, scaled by the current level
+        self.noise_pool = NoisePool(outputs)
+
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
+
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
+
     def action(self, s, use_noise=False):
 
-        with torch.no_grad():
-            pi = self.pi(torch.as_tensor(s.copy()).float().to(device))
-            pi = pi.cpu()[0]
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+            a = self.pi(self.input_buffer).cpu().numpy()[0]
 
         if use_noise:
 
-            pi = Normal(pi, self.noise).sample()
+            a += self.noise_pool.sample(self.noise)
 
             if self.noise > self.NOISE_MIN:
                 self.noise -= self.NOISE_DECAY
 
-        a = []
+        return np.clip(a, -1.0, 1.0, out=a)
+
+    def actions(self, states, use_noise=False):
+
+        # One forward pass gives the actions of all the environments
+        with torch.inference_mode():
+            a = self.pi(torch.as_tensor(states, device=device).float()).cpu().numpy()
+
+        if use_noise:
+
+            a += self.noise_pool.samples(len(a), self.noise)
 
-        for i in range(self.outputs):
-            a.append(pi[i].clamp(-1.0, 1.0).item())
+            # Decrease the noise once per step of the environments
+            if self.noise > self.NOISE_MIN:
+                self.noise -= self.NOISE_DECAY
 
-        return a
+        return np.clip(a, -1.0, 1.0, out=a)
 
     def store(self, *args):
 
@@ -147,63 +218,60 @@ class SAC:
 
         states = torch.as_tensor(np.float32(batch.s), device=device)
         next_states = torch.as_tensor(np.float32(batch.s2), device=device)
-        rewards = torch.as_tensor(batch.r, device=device)
-        done = torch.as_tensor(batch.done, device=device)
-        y = torch.zeros([self.BATCH_SIZE, 1], device=device)
-        actions = torch.zeros([self.outputs, self.BATCH_SIZE, 1], device=device)
+        actions = torch.as_tensor(np.float32(batch.a), device=device)
+        rewards = torch.as_tensor(np.float32(batch.r), device=device).view(-1, 1)
+        done = torch.as_tensor(np.float32(batch.done), device=device).view(-1, 1)
 
-        for i in range(self.BATCH_SIZE):
-            for j in range(self.outputs):
-                actions[j][i] = batch.a[i][j]
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, done))
+            self.warm = True
 
-        q1 = self.q1(states, actions)
-        q2 = self.q2(states, actions)
+        self.learner(states, next_states, actions, rewards, done)
 
-        with torch.no_grad():
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
 
-            next_pi = self.pi(next_states)
+    def learn(self, states, next_states, actions, rewards, done):
+
+        with autocast(self.bf16):
+            q1 = self.q1(states, actions).float()
+            q2 = self.q2(states, actions).float()
+
+        with torch.no_grad(), autocast(self.bf16):
+
+            next_pi = self.pi(next_states).float()
             next_pi_dist = Normal(next_pi, 1e-8)
             next_pi_logprob = next_pi_dist.log_prob(next_pi).sum(-1, keepdim=True)
-            next_pi_actions = torch.zeros([self.outputs, self.BATCH_SIZE, 1], device=device)
-
-            for i in range(self.BATCH_SIZE):
-                for j in range(self.outputs):
-                    next_pi_actions[j][i] = next_pi[i][j].clamp(-1.0, 1.0)
+            next_pi_actions = next_pi.clamp(-1.0, 1.0)
 
             next_q1 = self.q1_target(next_states, next_pi_actions)
             next_q2 = self.q2_target(next_states, next_pi_actions)
 
-            next_q = torch.min(next_q1, next_q2)
+            next_q = torch.min(next_q1, next_q2).float()
 
-            for i in range(self.BATCH_SIZE):
-
-                if done[i]:
-                    y[i] = rewards[i]
-                else:
-                    y[i] = rewards[i] + self.GAMMA * (next_q[i] - self.ALPHA * next_pi_logprob[i])
+            y = rewards + self.GAMMA * (next_q - self.ALPHA * next_pi_logprob) * (1.0 - done)
 
         q1_loss = torch.nn.MSELoss()(q1, y)
         q2_loss = torch.nn.MSELoss()(q2, y)
 
+        # The critics don't share any parameter, a single backward through
+        # both losses gives each one its own gradients
         self.optimizer_q1.zero_grad()
-        q1_loss.backward()
-        self.optimizer_q1.step()
-
         self.optimizer_q2.zero_grad()
-        q2_loss.backward()
+        (q1_loss + q2_loss).backward()
+        self.optimizer_q1.step()
         self.optimizer_q2.step()
 
-        pi = self.pi(states)
-        pi_dist = Normal(pi, 1e-8)
-        pi_actions = torch.zeros([self.outputs, self.BATCH_SIZE, 1], device=device)
+        with autocast(self.bf16):
 
-        for i in range(self.BATCH_SIZE):
-            for j in range(self.outputs):
-                pi_actions[j][i] = pi[i][j]
+            pi = self.pi(states).float()
+            pi_dist = Normal(pi, 1e-8)
 
-        q1 = self.q1(states, pi_actions)
-        q2 = self.q2(states, pi_actions)
-        q = torch.min(q1, q2)
+            q1 = self.q1(states, pi)
+            q2 = self.q2(states, pi)
+            q = torch.min(q1, q2).float()
 
         pi_loss = - (q - self.ALPHA * pi_dist.log_prob(pi).sum(axis=1)).mean()
 
@@ -212,38 +280,45 @@ class SAC:
         self.optimizer_pi.step()
 
         # Update target network
-        for target_param, source_param in zip(self.q1_target.parameters(), self.q1.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+        with torch.no_grad():
+
+            for target_param, source_param in zip(self.q1_target.parameters(), self.q1.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-        for target_param, source_param in zip(self.q2_target.parameters(), self.q2.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+            for target_param, source_param in zip(self.q2_target.parameters(), self.q2.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-def play_agent(env, agent):
+def play_agent(env, agent, weights=None, limit=0):
 
     results = []
     episode = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episode < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         rewards = 0
         s = env.reset()
 
         # Convert image to greyscale
-        s = np.dot(s[...,:3], [0.299, 0.587, 0.144])
+        s = preprocess(s)
 
         while 1:
 
             env.render()
 
-            a = agent.action(np.expand_dims(s, 0), True)
+            a = agent.action(s, True)
             s, r, done, _ = env.step(a)
 
             # Convert image to greyscale
-            s = np.dot(s[...,:3], [0.299, 0.587, 0.144])
+            s = preprocess(s)
 
             rewards += r
 
@@ -256,10 +331,12 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = []
+    total_steps = 0
+    start = time.perf_counter()
 
     while 1:
 
@@ -267,21 +344,23 @@ def train_agent(env, agent):
         s = env.reset()
 
         # Convert image to greyscale
-        s = np.dot(s[...,:3], [0.299, 0.587, 0.144])
+        s = preprocess(s)
 
         while 1:
 
-            a = agent.action(np.expand_dims(s, 0), True)
+            a = agent.action(s, True)
             s2, r, done, _ = env.step(a)
 
             # Convert image to greyscale
-            s2 = np.dot(s2[...,:3], [0.299, 0.587, 0.144])
+            s2 = preprocess(s2)
 
             rewards += r
 
             agent.store(s, s2, r, a, done)
             agent.train()
 
+            total_steps += 1
+
             s = s2
 
             if done:
@@ -293,13 +372,12 @@ def train_agent(env, agent):
 
                 score = np.sum(np.asarray(results)) / 100
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score >= 200:
-                    torch.save((
-                        agent.q1.state_dict(), \
-                        agent.q1_target.state_dict(), \
-                        agent.q2.state_dict(), \
-                        agent.q2_target.state_dict(), \
-                        agent.pi.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
                     print("Finished!!!")
                     exit()
 
@@ -307,27 +385,231 @@ def train_agent(env, agent):
 
                 print("Episode", episode,
                       "rewards", rewards,
-                      "score", score)
+                      "score", score,
+                      "steps/s", round(total_steps / (time.perf_counter() - start), 1))
 
                 # Save the state of the agent
                 if episode % 20 == 0:
-                    torch.save((
-                        agent.q1.state_dict(), \
-                        agent.q1_target.state_dict(), \
-                        agent.q2.state_dict(), \
-                        agent.q2_target.state_dict(), \
-                        agent.pi.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
 
                 break
 
+def train_pool_agent(env, agent, workers, repeat):
+
+    # The workers render the cars and write their greyscale frames in the
+    # shared memory ring of the pool
+    pool = EnvPool(env.spec.id, workers, preprocess.shape(env.observation_space.shape), preprocess, np.uint8,
+        functools.partial(ActionRepeat, repeat=repeat) if repeat > 1 else None)
+
+    episode = 0
+    results = []
+    rewards = np.zeros(workers)
+
+    try:
+        # The frames are copied out of the ring once, to be kept by the memory
+        s = pool.reset().copy()
+
+        while 1:
+
+            a = agent.actions(s, True)
+            pool.step_async(a)
+
+            # The learner trains while the workers step their environments
+            agent.train()
+
+            s2, r, done, infos = pool.step_wait()
+            s2 = s2.copy()
+
+            # The finished environments are already reset, their last frame
+            # is kept in the info
+            next_states = s2
+
+            if done.any():
+                next_states = s2.copy()
+                for i in np.flatnonzero(done):
+                    next_states[i] = infos[i]["terminal_observation"]
+
+            for i in range(workers):
+                agent.store(s[i], next_states[i], r[i], a[i], done[i])
+
+            s = s2
+
+            rewards += r
+
+            for i in np.flatnonzero(done):
+
+                # Calcul the score total over 100 episodes of all the workers
+                results.append(rewards[i])
+                if len(results) > 100:
+                    results.pop(0)
+
+                score = np.sum(np.asarray(results)) / 100
+
+                if score >= 200:
+                    save_agent(agent)
+                    print("Finished!!!")
+                    return
+
+                episode += 1
+
+                print("Episode", episode,
+                      "worker", i,
+                      "rewards", rewards[i],
+                      "score", score,
+                      "frames/s", round(pool.frames_per_second(), 1))
+
+                rewards[i] = 0
+
+                # Save the state of the agent
+                if episode % 20 == 0:
+                    save_agent(agent)
+
+    finally:
+        pool.close()
+
+def benchmark_agent(env):
+
+    BENCH_TRANSITIONS = 1000
+    BENCH_UPDATES = 200
+    BENCH_ACTIONS = 1000
+
+    # Record random transitions shared by both precisions
+    s = env.reset()
+
+    # Convert image to greyscale
+    s = preprocess(s)
+
+    for i in range(BENCH_TRANSITIONS):
+
+        a = env.action_space.sample().tolist()
+        s2, r, done, _ = env.step(a)
+
+        # Convert image to greyscale
+        s2 = preprocess(s2)
+
+        SAC.memory.append(SAC.experience(s, s2, r, a, done))
+
+        s = s2
+
+        if done:
+            s = env.reset()
+            s = preprocess(s)
+
+    for bf16 in [False, True]:
+
+        agent = SAC(list(preprocess.shape(env.observation_space.shape)),
+            env.action_space.shape[0], bf16)
+
+        # Update the networks on every call
+        agent.UPDATE_INTERVAL = 0
+
+        # Warm up before timing
+        for i in range(10):
+            agent.train()
+
+        start = time.perf_counter()
+        for i in range(BENCH_UPDATES):
+            agent.train()
+        elapsed = time.perf_counter() - start
+
+        print("Precision", "bfloat16" if bf16 else "float32",
+              "updates/s", round(BENCH_UPDATES / elapsed, 1))
+
+    # Time the actions with the exploration noise as during the training
+    agent = SAC(list(preprocess.shape(env.observation_space.shape)),
+        env.action_space.shape[0])
+    states = [experience.s for experience in SAC.memory]
+
+    # Warm up before timing
+    for i in range(100):
+        agent.action(states[i], True)
+
+    start = time.perf_counter()
+    for i in range(BENCH_ACTIONS):
+        agent.action(states[i % len(states)], True)
+    elapsed = time.perf_counter() - start
+
+    print("Action latency", round(elapsed / BENCH_ACTIONS * 1e6, 1), "us")
+
+def save_agent(agent):
+
+    torch.save((
+        agent.q1.state_dict(), \
+        agent.q1_target.state_dict(), \
+        agent.q2.state_dict(), \
+        agent.q2_target.state_dict(), \
+        agent.pi.state_dict()), SAVE_FILE_PATH)
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    # The preprocessing of the frames is part of the exported policy
+    program = [
+        ("frames", {
+            "crop_bottom": preprocess.crop_bottom,
+            "downsample": preprocess.downsample,
+            "coefficients": preprocess.coefficients}),
+        ("flatten", {}),
+        ("linear", dict(agent.pi.h1.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(agent.pi.h2.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(agent.pi.pi.named_parameters())),
+        ("tanh", {}),
+        ("clip", {"low": -1.0, "high": 1.0})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            x = preprocess(s)
+            expected = agent.pi(torch.as_tensor(np.float32(x), device=device))[0]
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, EXPORT_FILE_PATH, QUANTIZED_FILE_PATH, STUDENT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--quantize', flag_value='quantize', default=False)
+@click.option('--distill', flag_value='distill', default=False)
+@click.option('--bf16', is_flag=True, default=False)
+@click.option('--int8', is_flag=True, default=False)
+@click.option('--student', is_flag=True, default=False)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--workers', type=int, default=0)
+@click.option('--repeat', type=int, default=1)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, quantize, distill, bf16, int8, student, compile, publish, follow, workers, repeat, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -336,28 +618,101 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('CarRacing-v0')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    # Repeat each action for repeat ticks of the simulator
+    if repeat > 1:
+        env = ActionRepeat(env, repeat, render=bool(play))
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = SAC([env.observation_space.shape[0],
-        env.observation_space.shape[1]], env.action_space.shape[0])
+    agent = SAC(list(preprocess.shape(env.observation_space.shape)),
+        env.action_space.shape[0], bf16, compile)
+
+    loaded = False
 
     try:
-        q1, q1_target, q2, q2_target, pi, pi_target = torch.load(SAVE_FILE_PATH)
+        q1, q1_target, q2, q2_target, pi = torch.load(SAVE_FILE_PATH)
         agent.q1.load_state_dict(q1)
         agent.q1_target.load_state_dict(q1_target)
         agent.q2.load_state_dict(q2)
         agent.q2_target.load_state_dict(q2_target)
         agent.pi.load_state_dict(pi)
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        agent.q1.eval()
-        agent.q2.eval()
-        agent.pi.eval()
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and (export or quantize or distill):
+        raise click.ClickException("No agent saved in %s, train one first" % SAVE_FILE_PATH)
+
+    # Play with the int8 policy saved by --quantize
+    if int8:
+        agent.pi = quantize_policy(agent.pi)
+        agent.pi.load_state_dict(torch.load(QUANTIZED_FILE_PATH))
+        agent.input_buffer = agent.input_buffer.cpu()
+
+    # Play with the student saved by --distill
+    if student:
+        agent.pi = Student(list(preprocess.shape(env.observation_space.shape)),
+            env.action_space.shape[0]).to(device)
+        agent.pi.load_state_dict(torch.load(STUDENT_FILE_PATH))
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, publish)
+
+    try:
+        if play:
+            agent.q1.eval()
+            agent.q2.eval()
+            agent.pi.eval()
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.pi) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.pi, mean_action, evaluate, preprocess=preprocess,
+                wrapper=functools.partial(ActionRepeat, repeat=repeat) if repeat > 1 else None)
+        elif serve:
+            serve_agent(env, agent.pi, lambda a: a, serve, preprocess=preprocess)
+        elif quantize:
+            quantize_agent(env, agent, QUANTIZED_FILE_PATH, preprocess)
+        elif distill:
+            distill_agent(env, agent.pi, Student(agent.inputs, agent.outputs).to(device), STUDENT_FILE_PATH,
+                steps=2000, preprocess=preprocess)
+        elif train and workers:
+            train_pool_agent(env, agent, workers, repeat)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.pi, mean_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "return", -np.inf, preprocess=preprocess,
+                    wrapper=functools.partial(ActionRepeat, repeat=repeat) if repeat > 1 else None)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
@@ -5,13 +5,28 @@ import numpy as np
 import os
 import pickle
 import random
+import signal
+import time
 import torch
+import torch.multiprocessing as multiprocessing
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.distributions import Categorical
 
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, greedy_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import compile_learner, warmup_learner
+import vector_envs
+
 SAVE_FILE_PATH = "Carpole-A2C.torch"
+# One file by layout of the fused layers, their state_dicts differ
+FUSED_SAVE_FILE_PATH = "Carpole-A2C-fused-%s.torch"
+EXPORT_FILE_PATH = "Carpole-A2C.npz"
+SHARED_WEIGHTS_NAME = "Carpole-A2C-weights"
 
 # if gpu is used
 device = ("cuda" if torch.cuda.is_available() else "cpu")
@@ -29,7 +44,7 @@ class Actor(nn.Module):
     def forward(self, x):
 
         x = F.relu(self.h1(x))
-        return F.softmax(self.pi(x), dim=0)
+        return F.softmax(self.pi(x), dim=-1)
 
 class Critic(nn.Module):
 
@@ -46,6 +61,50 @@ class Critic(nn.Module):
         x = F.relu(self.h1(x))
         return self.v(x)
 
+class ActorCritic(nn.Module):
+
+    HIDDEN_LAYER_SIZE = 128
+
+    def __init__(self, inputs, outputs, shared=False):
+        super(ActorCritic, self).__init__()
+
+        self.shared = shared
+
+        # The first layers of the actor and the critic are fused in one wider
+        # layer, either shared by both heads or split between them
+        if shared:
+            self.h1 = nn.Linear(inputs, self.HIDDEN_LAYER_SIZE)
+        else:
+            self.h1 = nn.Linear(inputs, 2 * self.HIDDEN_LAYER_SIZE)
+
+        self.pi = nn.Linear(self.HIDDEN_LAYER_SIZE, outputs)
+        self.v = nn.Linear(self.HIDDEN_LAYER_SIZE, 1)
+
+    def forward(self, x):
+
+        x = F.relu(self.h1(x))
+
+        if self.shared:
+            x_pi, x_v = x, x
+        else:
+            x_pi, x_v = x.split(self.HIDDEN_LAYER_SIZE, dim=-1)
+
+        return F.softmax(self.pi(x_pi), dim=-1), self.v(x_v)
+
+class SharedAdam(optim.Adam):
+
+    def __init__(self, params, lr):
+        super(SharedAdam, self).__init__(params, lr=lr)
+
+        # The state is created up front in shared memory, every hogwild
+        # worker then steps the same moments without any lock
+        for group in self.param_groups:
+            for p in group['params']:
+                state = self.state[p]
+                state['step'] = torch.zeros(()).share_memory_()
+                state['exp_avg'] = torch.zeros_like(p).share_memory_()
+                state['exp_avg_sq'] = torch.zeros_like(p).share_memory_()
+
 class A2C:
 
     ALPHA = 0.001
@@ -54,25 +113,91 @@ class A2C:
     BATCH_SIZE = 32
     MEMORY_SIZE = 1000.0
 
+    # Steps of a hogwild worker per update, its on-policy updates see each
+    # transition once
+    N_STEPS = 5
+
     memory = []
     experience = namedtuple('Experience', ('s', 's2', 'r', 'a', 'done'))
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, fused=None, compile=False):
+
+        self.fused = fused
 
         # Create the model that will run on GPU
-        self.actor = Actor(inputs, outputs).to(device)
-        self.critic = Critic(inputs).to(device)
+        if fused:
+            self.model = ActorCritic(inputs, outputs, fused == 'shared').to(device)
+            self.optimizer = optim.Adam(self.model.parameters(), lr=self.ALPHA)
+        else:
+            self.actor = Actor(inputs, outputs).to(device)
+            self.critic = Critic(inputs).to(device)
+
+            self.optimizer_actor = optim.Adam(self.actor.parameters(), lr=self.ALPHA)
+            self.optimizer_critic = optim.Adam(self.critic.parameters(), lr=self.ALPHA)
 
-        self.optimizer_actor = optim.Adam(self.actor.parameters(), lr=self.ALPHA)
-        self.optimizer_critic = optim.Adam(self.critic.parameters(), lr=self.ALPHA)
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(inputs, device=device)
+
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
+
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
 
     def action(self, s):
 
-        with torch.no_grad():
-            pi = self.actor(torch.as_tensor(np.float32(s)).to(device)).cpu()
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+
+            if self.fused:
+                pi, _ = self.model(self.input_buffer)
+            else:
+                pi = self.actor(self.input_buffer)
+
+            # Get a random action
+            return sample_action(pi.tolist())
+
+    def actions(self, states):
+
+        # One forward pass gives the policies of all the environments
+        with torch.inference_mode():
+            x = torch.as_tensor(states, device=device)
+            pi = self.model(x)[0] if self.fused else self.actor(x)
+
+        return sample_actions(pi.cpu().numpy())
+
+    def values(self, states):
+
+        with torch.inference_mode():
+            x = torch.as_tensor(states, device=device)
+            v = self.model(x)[1] if self.fused else self.critic(x)
 
-        # Get a random action
-        return int(np.random.choice(len(pi), 1, p=pi.numpy())[0])
+        return v.cpu().numpy()[:, 0]
+
+    def share_memory(self):
+
+        # The parameters and the optimizer state move to shared memory, the
+        # gradients are dropped so each worker allocates its own
+        if self.fused:
+            self.model.share_memory()
+            self.model.zero_grad(set_to_none=True)
+            self.optimizer = SharedAdam(self.model.parameters(), self.ALPHA)
+        else:
+            self.actor.share_memory()
+            self.critic.share_memory()
+            self.actor.zero_grad(set_to_none=True)
+            self.critic.zero_grad(set_to_none=True)
+            self.optimizer_actor = SharedAdam(self.actor.parameters(), self.ALPHA)
+            self.optimizer_critic = SharedAdam(self.critic.parameters(), self.ALPHA)
+
+    def __getstate__(self):
+
+        # The hogwild workers get the shared networks and optimizers, the
+        # compiled learner and the publisher stay in this process
+        state = self.__dict__.copy()
+        state.update(learner=self.learn, warm=True, publisher=None)
+        return state
 
     def store(self, *args):
 
@@ -82,6 +207,14 @@ class A2C:
         if len(self.memory) > self.MEMORY_SIZE:
             self.memory.pop(0)
 
+    def store_batch(self, states, next_states, rewards, actions, done):
+
+        self.memory.extend(map(self.experience, states, next_states,
+                               rewards.tolist(), actions.tolist(), done.tolist()))
+
+        if len(self.memory) > self.MEMORY_SIZE:
+            del self.memory[:len(self.memory) - int(self.MEMORY_SIZE)]
+
     def train(self):
 
         if len(self.memory) < self.BATCH_SIZE:
@@ -93,49 +226,114 @@ class A2C:
         states = torch.as_tensor(np.float32(batch.s), device=device)
         next_states = torch.as_tensor(np.float32(batch.s2), device=device)
         actions = torch.as_tensor(batch.a, device=device)
-        rewards = torch.as_tensor(batch.r, device=device)
-        done = torch.as_tensor(batch.done, device=device)
+        rewards = torch.as_tensor(np.float32(batch.r), device=device)
+        done = torch.as_tensor(np.float32(batch.done), device=device)
 
-        pi = self.actor(states)
-        v = self.critic(states)
-        v2 = self.critic(next_states).detach()
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, done))
+            self.warm = True
 
-        adv = torch.zeros(self.BATCH_SIZE, device=device)
-        q = torch.zeros([self.BATCH_SIZE, 1], device=device)
-        log_probs = torch.zeros(self.BATCH_SIZE, device=device)
+        self.learner(states, next_states, actions, rewards, done)
 
-        entropy = 0
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
 
-        for i in range(self.BATCH_SIZE):
+    def learn(self, states, next_states, actions, rewards, done):
 
-            dist = Categorical(pi[i])
-            log_probs[i] = dist.log_prob(actions[i])
-            entropy += dist.entropy().mean()
+        if self.fused:
 
-            if done[i]:
-                q[i][0] = rewards[i]
-            else:
-                q[i][0] = rewards[i] + self.GAMMA * v2[i]
+            # A single forward computes the policy and the values of the
+            # states and of the next states
+            pi, v = self.model(torch.cat((states, next_states)))
+            pi = pi[:self.BATCH_SIZE]
+            v2 = v[self.BATCH_SIZE:].detach()
+            v = v[:self.BATCH_SIZE]
+        else:
+            pi = self.actor(states)
+            v = self.critic(states)
+            v2 = self.critic(next_states).detach()
 
-            adv[i] = q[i][0] - v[i]
+        dist = Categorical(pi)
+        log_probs = dist.log_prob(actions)
+        entropy = dist.entropy().sum()
+
+        q = (rewards + self.GAMMA * v2.squeeze(1) * (1.0 - done)).unsqueeze(1)
+        adv = (q - v).squeeze(1)
 
         loss_actor = -(log_probs * adv.detach()).mean() - self.ENTROPY * entropy
         loss_critic = torch.nn.MSELoss()(v, q)
 
-        self.optimizer_actor.zero_grad()
-        loss_actor.backward()
-        self.optimizer_actor.step()
+        self.optimize(loss_actor + loss_critic)
+
+    def learn_block(self, states, actions, returns):
+
+        if self.fused:
+            pi, v = self.model(states)
+        else:
+            pi = self.actor(states)
+            v = self.critic(states)
+
+        v = v.squeeze(1)
+
+        dist = Categorical(pi)
+        adv = returns - v
+
+        loss_actor = -(dist.log_prob(actions) * adv.detach()).mean() - self.ENTROPY * dist.entropy().sum()
+        loss_critic = torch.nn.MSELoss()(v, returns)
 
+        self.optimize(loss_actor + loss_critic)
+
+    def optimize(self, loss):
+
+        if self.fused:
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            return
+
+        # The actor and the critic don't share any parameter, a single
+        # backward through both losses gives each one its own gradients
+        self.optimizer_actor.zero_grad()
         self.optimizer_critic.zero_grad()
-        loss_critic.backward()
+        loss.backward()
+        self.optimizer_actor.step()
         self.optimizer_critic.step()
 
-def play_agent(env, agent):
+def sample_action(pi):
+
+    # Invert the cumulative distribution with a single uniform draw, the
+    # last action absorbs the rounding errors
+    u = random.random()
+
+    for a in range(len(pi) - 1):
+        u -= pi[a]
+        if u < 0:
+            return a
+
+    return len(pi) - 1
+
+def sample_actions(pi):
+
+    # Count for each row the actions whose cumulative probability stays
+    # under its uniform draw, the last action absorbs the rounding errors
+    u = np.random.random((len(pi), 1))
+    a = (pi.cumsum(1) <= u).sum(1)
+
+    return np.minimum(a, pi.shape[1] - 1)
+
+def play_agent(env, agent, weights=None, limit=0):
 
     results = []
     episodes = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episodes < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         steps = 0
         s = env.reset()
@@ -157,7 +355,7 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = []
@@ -190,9 +388,13 @@ def train_agent(env, agent):
 
                 score = np.sum(np.asarray(results)) / 100
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score >= 195:
                     print("Finished!!!")
-                    torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
                     exit()
 
                 episode += 1
@@ -203,18 +405,318 @@ def train_agent(env, agent):
 
                 # Save the state of the agent
                 if episode % 20 == 0:
-                    torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
+
+                break
+
+def train_vector_agent(envs, agent):
+
+    episode = 0
+    results = []
+    steps = np.zeros(envs.num_envs, dtype=int)
+    env_steps = 0
+
+    start = time.perf_counter()
+    s = envs.reset()
+
+    while 1:
+
+        a = agent.actions(s)
+        s2, r, done, infos = envs.step(a)
+
+        # The finished environments are already reset, their last state is
+        # kept in the info
+        next_states = vector_envs.final_observations(s2, done, infos)
+
+        agent.store_batch(s, next_states, r, a, done)
+        agent.train()
+
+        s = s2
+
+        steps += 1
+        env_steps += envs.num_envs
+
+        for i in np.flatnonzero(done):
+
+            # Same score as a single environment, over the last 100
+            # episodes of all the environments
+            results.append(steps[i])
+            if len(results) > 100:
+                results.pop(0)
+
+            score = np.sum(np.asarray(results)) / 100
+
+            if score >= 195:
+                print("Finished!!!")
+                save_agent(agent)
+                exit()
+
+            episode += 1
+
+            print("Episode", episode,
+                  "finished after", steps[i],
+                  "timesteps, score", score,
+                  "env steps/s", round(env_steps / (time.perf_counter() - start), 1))
+
+            steps[i] = 0
+
+            # Save the state of the agent
+            if episode % 20 == 0:
+                save_agent(agent)
 
+def run_worker(index, agent, episodes, stop):
+
+    # Each worker acts and learns on a single core
+    torch.set_num_threads(1)
+
+    # The trainer handles ctrl-c and stops the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    env = gym.make('CartPole-v0')
+
+    states = np.zeros((agent.N_STEPS, env.observation_space.shape[0]), dtype=np.float32)
+    actions = np.zeros(agent.N_STEPS, dtype=np.int64)
+    rewards = np.zeros(agent.N_STEPS, dtype=np.float32)
+
+    steps = 0
+    s = env.reset()
+
+    while not stop.is_set():
+
+        # Roll out N_STEPS steps or up to the end of the episode
+        for t in range(agent.N_STEPS):
+
+            a = agent.action(s)
+            s2, r, done, _ = env.step(a)
+
+            states[t] = s
+            actions[t] = a
+            rewards[t] = r
+
+            s = s2
+            steps += 1
+
+            if done:
                 break
 
+        # The n-step returns, bootstrapped from the value of the last state
+        # unless the episode ended
+        R = 0.0 if done else agent.values(np.float32(s)[np.newaxis])[0]
+        returns = np.zeros(t + 1, dtype=np.float32)
+
+        for i in reversed(range(t + 1)):
+            R = rewards[i] + agent.GAMMA * R
+            returns[i] = R
+
+        # The gradients of this worker go straight into the shared
+        # parameters, without locking out the other workers
+        agent.learn_block(
+            torch.as_tensor(states[:t + 1], device=device),
+            torch.as_tensor(actions[:t + 1], device=device),
+            torch.as_tensor(returns, device=device))
+
+        if done:
+            episodes.put((index, steps))
+            steps = 0
+            s = env.reset()
+
+def train_hogwild_agent(agent, workers, save=True):
+
+    # Share the networks and the optimizers with the workers
+    agent.share_memory()
+
+    context = multiprocessing.get_context("spawn")
+    episodes = context.Queue()
+    stop = context.Event()
+
+    processes = [context.Process(target=run_worker, args=(i, agent, episodes, stop), daemon=True)
+                 for i in range(workers)]
+
+    start = time.perf_counter()
+
+    for process in processes:
+        process.start()
+
+    episode = 0
+    results = []
+    env_steps = 0
+
+    try:
+        while 1:
+
+            index, steps = episodes.get()
+
+            # Calcul the score total over 100 episodes of all the workers
+            results.append(steps)
+            if len(results) > 100:
+                results.pop(0)
+
+            score = np.sum(np.asarray(results)) / 100
+
+            env_steps += steps
+            elapsed = time.perf_counter() - start
+
+            if score >= 195:
+                print("Finished!!!")
+                print("Workers", workers,
+                      "score 195 reached in", round(elapsed, 1), "s,",
+                      episode + 1, "episodes,",
+                      env_steps, "env steps")
+                if save:
+                    save_agent(agent)
+                return elapsed
+
+            episode += 1
+
+            print("Episode", episode,
+                  "worker", index,
+                  "finished after", steps,
+                  "timesteps, score", score,
+                  "env steps/s", round(env_steps / elapsed, 1))
+
+            # Share the weights the workers reached with the play processes
+            if agent.publisher:
+                agent.publisher.publish()
+
+            # Save the state of the agent
+            if save and episode % 20 == 0:
+                save_agent(agent)
+
+    finally:
+        stop.set()
+
+        for process in processes:
+            process.terminate()
+
+def benchmark_hogwild(env, workers):
+
+    # Time a fresh agent to the score of 195 for 1, 2, 4... up to workers
+    # processes, the fresh agents must not replace the saved one
+    times = []
+    k = 1
+
+    while k <= workers:
+        agent = A2C(env.observation_space.shape[0], env.action_space.n)
+        times.append((k, train_hogwild_agent(agent, k, save=False)))
+        k *= 2
+
+    for k, elapsed in times:
+        print("Workers", k, "time to score 195", round(elapsed, 1), "s")
+
+def benchmark_agent(env):
+
+    BENCH_ACTIONS = 10000
+    BENCH_UPDATES = 1000
+
+    # Record random transitions shared by all the layouts
+    states = []
+    s = env.reset()
+
+    for i in range(int(A2C.MEMORY_SIZE)):
+
+        a = env.action_space.sample()
+        s2, r, done, _ = env.step(a)
+
+        states.append(s)
+        A2C.memory.append(A2C.experience(s, s2, r, a, done))
+
+        s = env.reset() if done else s2
+
+    for fused in [None, 'split', 'shared']:
+
+        agent = A2C(env.observation_space.shape[0], env.action_space.n, fused)
+
+        # Warm up before timing
+        for i in range(100):
+            agent.action(states[i])
+
+        start = time.perf_counter()
+        for i in range(BENCH_ACTIONS):
+            agent.action(states[i % len(states)])
+        action_time = (time.perf_counter() - start) / BENCH_ACTIONS
+
+        start = time.perf_counter()
+        for i in range(BENCH_UPDATES):
+            agent.train()
+        update_time = (time.perf_counter() - start) / BENCH_UPDATES
+
+        print("Layout", fused or "separate",
+              "action latency", round(action_time * 1e6, 1), "us,",
+              "update time", round(update_time * 1e3, 3), "ms")
+
+def save_agent(agent):
+
+    if agent.fused:
+        torch.save(agent.model.state_dict(), FUSED_SAVE_FILE_PATH % agent.fused)
+    else:
+        torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    model = agent.model if agent.fused else agent.actor
+    h1 = dict(model.h1.named_parameters())
+
+    # Only the actor half of a split fused layer is needed
+    if agent.fused == 'split':
+        h1 = {name: value[:ActorCritic.HIDDEN_LAYER_SIZE] for name, value in h1.items()}
+
+    program = [
+        ("linear", h1),
+        ("relu", {}),
+        ("linear", dict(model.pi.named_parameters())),
+        ("softmax", {}),
+        ("sample", {})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            x = torch.as_tensor(np.float32(s), device=device)
+            expected = agent.model(x)[0] if agent.fused else agent.actor(x)
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, FUSED_SAVE_FILE_PATH % 'shared', FUSED_SAVE_FILE_PATH % 'split', EXPORT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--fused', type=click.Choice(['shared', 'split']), default=None)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--envs', type=int, default=0)
+@click.option('--asynchronous', is_flag=True, default=False)
+@click.option('--workers', type=int, default=0)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, fused, compile, publish, follow, envs, asynchronous, workers, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -223,24 +725,86 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('CartPole-v0')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    if bench and workers:
+        benchmark_hogwild(env, workers)
+        exit()
+    elif bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = A2C(env.observation_space.shape[0], env.action_space.n)
+    agent = A2C(env.observation_space.shape[0], env.action_space.n, fused, compile)
 
-    try:
-        critic, actor = torch.load(SAVE_FILE_PATH)
+    loaded = False
 
-        agent.critic.load_state_dict(critic)
-        agent.actor.load_state_dict(actor)
-        agent.critic.eval()
-        agent.actor.eval()
+    try:
+        if fused:
+            agent.model.load_state_dict(torch.load(FUSED_SAVE_FILE_PATH % fused))
+            agent.model.eval()
+        else:
+            critic, actor = torch.load(SAVE_FILE_PATH)
+
+            agent.critic.load_state_dict(critic)
+            agent.actor.load_state_dict(actor)
+            agent.critic.eval()
+            agent.actor.eval()
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and export:
+        raise click.ClickException("No agent saved in %s, train one first" % (FUSED_SAVE_FILE_PATH % fused if fused else SAVE_FILE_PATH))
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor, publish)
+
+    try:
+        if play:
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.model if fused else agent.actor, greedy_action, evaluate)
+        elif serve:
+            if fused:
+                serve_agent(env, agent.model, lambda pi_v: sample_action(pi_v[0]), serve)
+            else:
+                serve_agent(env, agent.actor, sample_action, serve)
+        elif train and envs:
+            train_vector_agent(vector_envs.make('CartPole-v0', envs, asynchronous), agent)
+        elif train and workers:
+            train_hogwild_agent(agent, workers)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.model if fused else agent.actor, greedy_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "length", -np.inf)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
@@ -5,12 +5,23 @@ import numpy as np
 import os
 import pickle
 import random
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, greedy_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import compile_learner, warmup_learner
+import vector_envs
+
 SAVE_FILE_PATH = "Carpole-DQN.torch"
+EXPORT_FILE_PATH = "Carpole-DQN.npz"
+SHARED_WEIGHTS_NAME = "Carpole-DQN-weights"
 
 # if gpu is used
 device = ("cuda" if torch.cuda.is_available() else "cpu")
@@ -37,31 +48,45 @@ class DQN:
     EPSILON = 1.0
     EPSILON_MIN = 0.01
     EPSILON_DECAY = 0.995
+    EPSILON_SPREAD = 2
     BATCH_SIZE = 64
     MEMORY_SIZE = 1000
 
     experience = namedtuple('Experience', ('s', 's2', 'r', 'a', 'done'))
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, compile=False):
 
         self.memory = []
         self.epsilon = self.EPSILON
+        self.outputs = outputs
 
         # Create the model that will run on GPU
         self.model = Model(inputs, outputs).to(device)
         self.optimizer = optim.RMSprop(self.model.parameters(), lr=self.ALPHA)
 
-    def action(self, s):
+        self.batch_index = torch.arange(self.BATCH_SIZE, device=device)
 
-        with torch.no_grad():
-            q = self.model(torch.as_tensor(np.float32(s)).to(device)).cpu()
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(inputs, device=device)
+
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
 
-        # e-Greedy explore
-        greedy = np.full(len(q), self.epsilon / (len(q)-1))
-        greedy[np.argmax(q)] = 1.0 - self.epsilon
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
 
-        # Get a random action
-        a = int(np.random.choice(len(q), 1, p=greedy.flatten())[0])
+    def action(self, s):
+
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+            a = int(self.model(self.input_buffer).argmax())
+
+        # e-Greedy explore, a single draw decides to explore and the random
+        # action is then picked among the other actions
+        if random.random() < self.epsilon:
+            other = random.randrange(self.outputs - 1)
+            a = other + (other >= a)
 
         # Decrease the exploration rate
         if self.epsilon > self.EPSILON_MIN:
@@ -71,6 +96,29 @@ class DQN:
 
         return a
 
+    def actions(self, states):
+
+        n = len(states)
+
+        # One forward pass picks the greedy actions of all the environments
+        with torch.inference_mode():
+            q = self.model(torch.as_tensor(states, device=device))
+            a = q.argmax(1).cpu().numpy()
+
+        # Every environment explores at its own rate, the first one follows
+        # the schedule and the last one explores the least
+        epsilons = self.epsilon ** (1 + np.arange(n) / max(n - 1, 1) * self.EPSILON_SPREAD)
+        other = np.random.randint(self.outputs - 1, size=n)
+        a = np.where(np.random.random(n) < epsilons, other + (other >= a), a)
+
+        # Decrease the exploration rate once per step of the environments
+        if self.epsilon > self.EPSILON_MIN:
+            self.epsilon *= self.EPSILON_DECAY
+        else:
+            self.epsilon = self.EPSILON_MIN
+
+        return a
+
     def store(self, *args):
 
         self.memory.append(self.experience(*args))
@@ -78,6 +126,14 @@ class DQN:
         if len(self.memory) > self.MEMORY_SIZE:
             self.memory.pop(0)
 
+    def store_batch(self, states, next_states, rewards, actions, done):
+
+        self.memory.extend(map(self.experience, states, next_states,
+                               rewards.tolist(), actions.tolist(), done.tolist()))
+
+        if len(self.memory) > self.MEMORY_SIZE:
+            del self.memory[:len(self.memory) - self.MEMORY_SIZE]
+
     def train(self):
 
         if len(self.memory) < self.BATCH_SIZE:
@@ -89,32 +145,47 @@ class DQN:
         states = torch.as_tensor(np.float32(batch.s), device=device)
         next_states = torch.as_tensor(np.float32(batch.s2), device=device)
         actions = torch.as_tensor(batch.a, device=device)
-        rewards = torch.as_tensor(batch.r, device=device)
-        done = torch.as_tensor(batch.done, device=device)
+        rewards = torch.as_tensor(np.float32(batch.r), device=device)
+        done = torch.as_tensor(np.float32(batch.done), device=device)
+
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, done))
+            self.warm = True
+
+        self.learner(states, next_states, actions, rewards, done)
+
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
+
+    def learn(self, states, next_states, actions, rewards, done):
 
         q = self.model(states)
         q2 = self.model(next_states).detach()
-        qtarget = q.clone()
+        qtarget = q.detach().clone()
 
-        for i in range(self.BATCH_SIZE):
-
-            if done[i]:
-                qtarget[i, actions[i]] = rewards[i]
-            else:
-                qtarget[i, actions[i]] = rewards[i] + self.GAMMA * torch.max(q2[i])
+        # Only the Q value of the action taken moves toward its target
+        qtarget[self.batch_index, actions] = \
+            rewards + self.GAMMA * torch.max(q2, 1)[0] * (1.0 - done)
 
         loss = torch.nn.MSELoss()(q, qtarget)
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-def play_agent(env, agent):
+def play_agent(env, agent, weights=None, limit=0):
 
     results = []
     episodes = 0
     steps = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episodes < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         steps = 0
         s = env.reset()
@@ -136,7 +207,7 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = []
@@ -169,6 +240,10 @@ def train_agent(env, agent):
 
                 score = np.sum(np.asarray(results)) / 100
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score >= 195:
                     print("Finished!!!")
                     exit()
@@ -185,14 +260,144 @@ def train_agent(env, agent):
 
                 break
 
+def train_vector_agent(envs, agent):
+
+    episode = 0
+    results = []
+    steps = np.zeros(envs.num_envs, dtype=int)
+    env_steps = 0
+
+    start = time.perf_counter()
+    s = envs.reset()
+
+    while 1:
+
+        a = agent.actions(s)
+        s2, r, done, infos = envs.step(a)
+
+        # The finished environments are already reset, their last state is
+        # kept in the info
+        next_states = vector_envs.final_observations(s2, done, infos)
+
+        agent.store_batch(s, next_states, r, a, done)
+        agent.train()
+
+        s = s2
+
+        steps += 1
+        env_steps += envs.num_envs
+
+        for i in np.flatnonzero(done):
+
+            # Same score as a single environment, over the last 100
+            # episodes of all the environments
+            results.append(steps[i])
+            if len(results) > 100:
+                results.pop(0)
+
+            score = np.sum(np.asarray(results)) / 100
+
+            if score >= 195:
+                print("Finished!!!")
+                exit()
+
+            episode += 1
+
+            print("Episode", episode,
+                  "finished after", steps[i],
+                  "timesteps, score", score,
+                  "env steps/s", round(env_steps / (time.perf_counter() - start), 1))
+
+            steps[i] = 0
+
+            # Save the state of the agent
+            if episode % 20 == 0:
+                torch.save(agent.model.state_dict(), SAVE_FILE_PATH)
+
+def benchmark_agent(env):
+
+    BENCH_ACTIONS = 10000
+
+    # Record the states of random episodes
+    states = []
+    s = env.reset()
+
+    for i in range(1000):
+
+        states.append(s)
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    agent = DQN(env.observation_space.shape[0], env.action_space.n)
+
+    # Warm up before timing
+    for i in range(100):
+        agent.action(states[i])
+
+    start = time.perf_counter()
+    for i in range(BENCH_ACTIONS):
+        agent.action(states[i % len(states)])
+    elapsed = time.perf_counter() - start
+
+    print("Action latency", round(elapsed / BENCH_ACTIONS * 1e6, 1), "us")
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    program = [
+        ("linear", dict(agent.model.h1.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(agent.model.q.named_parameters())),
+        ("argmax", {})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            expected = agent.model(torch.as_tensor(np.float32(s), device=device))
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, EXPORT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--envs', type=int, default=0)
+@click.option('--asynchronous', is_flag=True, default=False)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, compile, publish, follow, envs, asynchronous, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -201,20 +406,70 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('CartPole-v0')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = DQN(env.observation_space.shape[0], env.action_space.n)
+    agent = DQN(env.observation_space.shape[0], env.action_space.n, compile)
+
+    loaded = False
 
     try:
         agent.model.load_state_dict(torch.load(SAVE_FILE_PATH))
         agent.model.eval()
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and export:
+        raise click.ClickException("No agent saved in %s, train one first" % SAVE_FILE_PATH)
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model, publish)
+
+    try:
+        if play:
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.model) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.model, greedy_action, evaluate)
+        elif serve:
+            serve_agent(env, agent.model, lambda q: int(np.argmax(q)), serve)
+        elif train and envs:
+            train_vector_agent(vector_envs.make('CartPole-v0', envs, asynchronous), agent)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.model, greedy_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "length", -np.inf)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
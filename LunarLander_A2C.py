@@ -5,13 +5,26 @@ import numpy as np
 import os
 import pickle
 import random
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.distributions import Categorical
 
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, greedy_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import compile_learner, warmup_learner
+import vector_envs
+
 SAVE_FILE_PATH = "LunarLander-A2C.torch"
+# One file by layout of the fused layers, their state_dicts differ
+FUSED_SAVE_FILE_PATH = "LunarLander-A2C-fused-%s.torch"
+EXPORT_FILE_PATH = "LunarLander-A2C.npz"
+SHARED_WEIGHTS_NAME = "LunarLander-A2C-weights"
 
 class Actor(nn.Module):
 
@@ -28,7 +41,7 @@ class Actor(nn.Module):
 
         x = F.relu(self.h1(x))
         x = F.relu(self.h2(x))
-        return F.softmax(self.pi(x), dim=0)
+        return F.softmax(self.pi(x), dim=-1)
 
 class Critic(nn.Module):
 
@@ -47,6 +60,43 @@ class Critic(nn.Module):
         x = F.relu(self.h2(x))
         return self.v(x)
 
+class ActorCritic(nn.Module):
+
+    HIDDEN_LAYER_SIZE = 128
+
+    def __init__(self, inputs, outputs, shared=False):
+        super(ActorCritic, self).__init__()
+
+        self.shared = shared
+
+        # The first layers of the actor and the critic are fused in one wider
+        # layer, either followed by a trunk shared by both heads or split
+        # between them
+        if shared:
+            self.h1 = nn.Linear(inputs, self.HIDDEN_LAYER_SIZE)
+            self.h2 = nn.Linear(self.HIDDEN_LAYER_SIZE, self.HIDDEN_LAYER_SIZE)
+        else:
+            self.h1 = nn.Linear(inputs, 2 * self.HIDDEN_LAYER_SIZE)
+            self.h2_pi = nn.Linear(self.HIDDEN_LAYER_SIZE, self.HIDDEN_LAYER_SIZE)
+            self.h2_v = nn.Linear(self.HIDDEN_LAYER_SIZE, self.HIDDEN_LAYER_SIZE)
+
+        self.pi = nn.Linear(self.HIDDEN_LAYER_SIZE, outputs)
+        self.v = nn.Linear(self.HIDDEN_LAYER_SIZE, 1)
+
+    def forward(self, x):
+
+        x = F.relu(self.h1(x))
+
+        if self.shared:
+            x = F.relu(self.h2(x))
+            x_pi, x_v = x, x
+        else:
+            x_pi, x_v = x.split(self.HIDDEN_LAYER_SIZE, dim=-1)
+            x_pi = F.relu(self.h2_pi(x_pi))
+            x_v = F.relu(self.h2_v(x_v))
+
+        return F.softmax(self.pi(x_pi), dim=-1), self.v(x_v)
+
 class A2C:
 
     ALPHA = 0.0001
@@ -55,27 +105,71 @@ class A2C:
     MEMORY_SIZE = 10000.0
     UPDATE = 1
 
+    # Steps of all the environments per update of the synchronous mode, its
+    # on-policy updates see each transition once and take larger steps
+    N_STEPS = 5
+    BLOCK_ALPHA = 0.0003
+    ENTROPY = 0.01
+
     experience = namedtuple('Experience', ('s', 's2', 'r', 'a', 'done'))
 
     memory = []
     update = 0
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, fused=None, compile=False):
+
+        self.fused = fused
 
         # Create the model that will run on GPU
-        self.actor = Actor(inputs, outputs)
-        self.critic = Critic(inputs)
+        if fused:
+            self.model = ActorCritic(inputs, outputs, fused == 'shared')
+            self.optimizer = optim.Adam(self.model.parameters(), lr=self.ALPHA)
+        else:
+            self.actor = Actor(inputs, outputs)
+            self.critic = Critic(inputs)
+
+            self.optimizer_actor = optim.Adam(self.actor.parameters(), lr=self.ALPHA)
+            self.optimizer_critic = optim.Adam(self.critic.parameters(), lr=self.ALPHA)
+
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(inputs)
 
-        self.optimizer_actor = optim.Adam(self.actor.parameters(), lr=self.ALPHA)
-        self.optimizer_critic = optim.Adam(self.critic.parameters(), lr=self.ALPHA)
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
+
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
 
     def action(self, s):
 
-        with torch.no_grad():
-            pi = self.actor(torch.as_tensor(np.float32(s))).cpu()
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+
+            if self.fused:
+                pi, _ = self.model(self.input_buffer)
+            else:
+                pi = self.actor(self.input_buffer)
+
+            # Get a random action
+            return sample_action(pi.tolist())
+
+    def actions(self, states):
 
-        # Get a random action
-        return int(np.random.choice(len(pi), 1, p=pi.numpy())[0])
+        # One forward pass gives the policies of all the environments
+        with torch.inference_mode():
+            x = torch.as_tensor(states)
+            pi = self.model(x)[0] if self.fused else self.actor(x)
+
+        return sample_actions(pi.numpy())
+
+    def values(self, states):
+
+        with torch.inference_mode():
+            x = torch.as_tensor(states)
+            v = self.model(x)[1] if self.fused else self.critic(x)
+
+        return v.numpy()[:, 0]
 
     def store(self, *args):
 
@@ -102,48 +196,143 @@ class A2C:
         states = torch.as_tensor(np.float32(batch.s))
         next_states = torch.as_tensor(np.float32(batch.s2))
         actions = torch.as_tensor(batch.a)
-        rewards = torch.as_tensor(batch.r)
-        done = torch.as_tensor(batch.done)
+        rewards = torch.as_tensor(np.float32(batch.r))
+        done = torch.as_tensor(np.float32(batch.done))
 
-        pi = self.actor(states)
-        v = self.critic(states)
-        v2 = self.critic(next_states).detach()
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, done))
+            self.warm = True
 
-        adv = torch.zeros(self.BATCH_SIZE)
-        q = torch.zeros([self.BATCH_SIZE, 1])
-        log_probs = torch.zeros(self.BATCH_SIZE)
+        self.learner(states, next_states, actions, rewards, done)
 
-        entropy = 0
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
 
-        for i in range(self.BATCH_SIZE):
+    def train_block(self, states, actions, rewards, done, last_states):
 
-            dist = Categorical(pi[i])
-            log_probs[i] = dist.log_prob(actions[i])
+        # The n-step returns of the whole block, bootstrapped from the values
+        # of the states after its last step and cut at the end of the
+        # episodes. Each step updates the returns of all the environments
+        returns = np.zeros(rewards.shape, dtype=np.float32)
+        R = self.values(last_states)
 
-            if done[i]:
-                q[i][0] = rewards[i]
-            else:
-                q[i][0] = rewards[i] + self.GAMMA * v2[i]
+        for t in reversed(range(len(rewards))):
+            R = rewards[t] + self.GAMMA * R * (1.0 - done[t])
+            returns[t] = R
+
+        # One update with the N_STEPS x environments transitions of the block
+        self.learn_block(
+            torch.as_tensor(states).flatten(0, 1),
+            torch.as_tensor(actions).flatten(),
+            torch.as_tensor(returns).flatten())
+
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
+
+    def learn_block(self, states, actions, returns):
 
-            adv[i] = q[i][0] - v[i]
+        if self.fused:
+            pi, v = self.model(states)
+        else:
+            pi = self.actor(states)
+            v = self.critic(states)
+
+        v = v.squeeze(1)
+
+        dist = Categorical(pi)
+        adv = returns - v
+
+        # The entropy bonus keeps the policies of the block exploring
+        loss_actor = - (dist.log_prob(actions) * adv.detach()).mean() - self.ENTROPY * dist.entropy().mean()
+        loss_critic = torch.nn.MSELoss()(v, returns)
+
+        self.optimize(loss_actor + loss_critic)
+
+    def learn(self, states, next_states, actions, rewards, done):
+
+        if self.fused:
+
+            # A single forward computes the policy and the values of the
+            # states and of the next states
+            pi, v = self.model(torch.cat((states, next_states)))
+            pi = pi[:self.BATCH_SIZE]
+            v2 = v[self.BATCH_SIZE:].detach()
+            v = v[:self.BATCH_SIZE]
+        else:
+            pi = self.actor(states)
+            v = self.critic(states)
+            v2 = self.critic(next_states).detach()
+
+        log_probs = Categorical(pi).log_prob(actions)
+
+        q = (rewards + self.GAMMA * v2.squeeze(1) * (1.0 - done)).unsqueeze(1)
+        adv = (q - v).squeeze(1)
 
         loss_actor = - (log_probs * adv.detach()).mean()
         loss_critic = torch.nn.MSELoss()(v, q)
 
-        self.optimizer_actor.zero_grad()
-        loss_actor.backward()
-        self.optimizer_actor.step()
+        self.optimize(loss_actor + loss_critic)
+
+    def set_learning_rate(self, lr):
+
+        optimizers = [self.optimizer] if self.fused else [self.optimizer_actor, self.optimizer_critic]
+
+        for optimizer in optimizers:
+            for group in optimizer.param_groups:
+                group['lr'] = lr
 
+    def optimize(self, loss):
+
+        if self.fused:
+            self.optimizer.zero_grad()
+            loss.backward()
+            self.optimizer.step()
+            return
+
+        # The actor and the critic don't share any parameter, a single
+        # backward through both losses gives each one its own gradients
+        self.optimizer_actor.zero_grad()
         self.optimizer_critic.zero_grad()
-        loss_critic.backward()
+        loss.backward()
+        self.optimizer_actor.step()
         self.optimizer_critic.step()
 
-def play_agent(env, agent):
+def sample_action(pi):
+
+    # Invert the cumulative distribution with a single uniform draw, the
+    # last action absorbs the rounding errors
+    u = random.random()
+
+    for a in range(len(pi) - 1):
+        u -= pi[a]
+        if u < 0:
+            return a
+
+    return len(pi) - 1
+
+def sample_actions(pi):
+
+    # Count for each row the actions whose cumulative probability stays
+    # under its uniform draw, the last action absorbs the rounding errors
+    u = np.random.random((len(pi), 1))
+    a = (pi.cumsum(1) <= u).sum(1)
+
+    return np.minimum(a, pi.shape[1] - 1)
+
+def play_agent(env, agent, weights=None, limit=0):
 
     results = []
     episodes = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episodes < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         rewards = 0
         s = env.reset()
@@ -166,10 +355,13 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = []
+    env_steps = 0
+
+    start = time.perf_counter()
 
     while 1:
 
@@ -182,6 +374,7 @@ def train_agent(env, agent):
             s2, r, done, _ = env.step(a)
 
             rewards += r
+            env_steps += 1
 
             agent.store(s, s2, r, a, done)
             agent.train()
@@ -197,6 +390,10 @@ def train_agent(env, agent):
 
                 score = np.sum(np.asarray(results)) / 100
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score >= 200:
                     print("Finished!!!")
                     exit()
@@ -205,22 +402,202 @@ def train_agent(env, agent):
 
                 print("Episode", episode,
                       "rewards", rewards,
-                      "score", score)
+                      "score", score,
+                      "env steps", env_steps,
+                      "env steps/s", round(env_steps / (time.perf_counter() - start), 1))
 
                 # Save the state of the agent
                 if episode % 20 == 0:
-                    torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
 
                 break
 
+def train_vector_agent(envs, agent):
+
+    episode = 0
+    results = []
+    rewards = np.zeros(envs.num_envs)
+    env_steps = 0
+
+    agent.set_learning_rate(agent.BLOCK_ALPHA)
+
+    start = time.perf_counter()
+    s = envs.reset()
+
+    # The environments step in lockstep for N_STEPS steps, the block of
+    # transitions gives one update
+    states = np.zeros((agent.N_STEPS,) + s.shape, dtype=np.float32)
+    actions = np.zeros((agent.N_STEPS, envs.num_envs), dtype=np.int64)
+    block_rewards = np.zeros((agent.N_STEPS, envs.num_envs), dtype=np.float32)
+    block_done = np.zeros((agent.N_STEPS, envs.num_envs), dtype=np.float32)
+
+    while 1:
+
+        for t in range(agent.N_STEPS):
+
+            a = agent.actions(s)
+            s2, r, done, _ = envs.step(a)
+
+            # The finished environments are already reset, their returns are
+            # cut so their last state is not needed
+            states[t] = s
+            actions[t] = a
+            block_rewards[t] = r
+            block_done[t] = done
+
+            s = s2
+
+            rewards += r
+            env_steps += envs.num_envs
+
+            for i in np.flatnonzero(done):
+
+                # Same score as a single environment, over the last 100
+                # episodes of all the environments
+                results.append(rewards[i])
+                if len(results) > 100:
+                    results.pop(0)
+
+                score = np.sum(np.asarray(results)) / 100
+
+                if score >= 200:
+                    print("Finished!!!")
+                    save_agent(agent)
+                    exit()
+
+                episode += 1
+
+                print("Episode", episode,
+                      "rewards", rewards[i],
+                      "score", score,
+                      "env steps", env_steps,
+                      "env steps/s", round(env_steps / (time.perf_counter() - start), 1))
+
+                rewards[i] = 0
+
+                # Save the state of the agent
+                if episode % 20 == 0:
+                    save_agent(agent)
+
+        agent.train_block(states, actions, block_rewards, block_done, s)
+
+def benchmark_agent(env):
+
+    BENCH_ACTIONS = 10000
+    BENCH_UPDATES = 1000
+
+    # Record random transitions shared by all the layouts
+    states = []
+    s = env.reset()
+
+    for i in range(int(A2C.MEMORY_SIZE)):
+
+        a = env.action_space.sample()
+        s2, r, done, _ = env.step(a)
+
+        states.append(s)
+        A2C.memory.append(A2C.experience(s, s2, r, a, done))
+
+        s = env.reset() if done else s2
+
+    for fused in [None, 'split', 'shared']:
+
+        agent = A2C(env.observation_space.shape[0], env.action_space.n, fused)
+
+        # Warm up before timing
+        for i in range(100):
+            agent.action(states[i])
+
+        start = time.perf_counter()
+        for i in range(BENCH_ACTIONS):
+            agent.action(states[i % len(states)])
+        action_time = (time.perf_counter() - start) / BENCH_ACTIONS
+
+        start = time.perf_counter()
+        for i in range(BENCH_UPDATES):
+            agent.train()
+        update_time = (time.perf_counter() - start) / BENCH_UPDATES
+
+        print("Layout", fused or "separate",
+              "action latency", round(action_time * 1e6, 1), "us,",
+              "update time", round(update_time * 1e3, 3), "ms")
+
+def save_agent(agent):
+
+    if agent.fused:
+        torch.save(agent.model.state_dict(), FUSED_SAVE_FILE_PATH % agent.fused)
+    else:
+        torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    model = agent.model if agent.fused else agent.actor
+    h1 = dict(model.h1.named_parameters())
+
+    # Only the actor half of a split fused layer is needed
+    if agent.fused == 'split':
+        h1 = {name: value[:ActorCritic.HIDDEN_LAYER_SIZE] for name, value in h1.items()}
+
+    h2 = model.h2_pi if agent.fused == 'split' else model.h2
+
+    program = [
+        ("linear", h1),
+        ("relu", {}),
+        ("linear", dict(h2.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(model.pi.named_parameters())),
+        ("softmax", {}),
+        ("sample", {})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            x = torch.as_tensor(np.float32(s))
+            expected = agent.model(x)[0] if agent.fused else agent.actor(x)
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, FUSED_SAVE_FILE_PATH % 'shared', FUSED_SAVE_FILE_PATH % 'split', EXPORT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--fused', type=click.Choice(['shared', 'split']), default=None)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+@click.option('--envs', type=int, default=0)
+@click.option('--asynchronous', is_flag=True, default=False)
+def run(play, train, clean, bench, export, serve, fused, compile, publish, follow, evaluate, eval_async, envs, asynchronous, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -229,23 +606,82 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('LunarLander-v2')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = A2C(env.observation_space.shape[0], env.action_space.n)
+    agent = A2C(env.observation_space.shape[0], env.action_space.n, fused, compile)
+
+    loaded = False
 
     try:
-        critic, actor = torch.load(SAVE_FILE_PATH)
-        agent.critic.load_state_dict(critic)
-        agent.actor.load_state_dict(actor)
+        if fused:
+            agent.model.load_state_dict(torch.load(FUSED_SAVE_FILE_PATH % fused))
+        else:
+            critic, actor = torch.load(SAVE_FILE_PATH)
+            agent.critic.load_state_dict(critic)
+            agent.actor.load_state_dict(actor)
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        agent.critic.eval()
-        agent.actor.eval()
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and export:
+        raise click.ClickException("No agent saved in %s, train one first" % (FUSED_SAVE_FILE_PATH % fused if fused else SAVE_FILE_PATH))
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor, publish)
+
+    try:
+        if play:
+            if fused:
+                agent.model.eval()
+            else:
+                agent.critic.eval()
+                agent.actor.eval()
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.model if fused else agent.actor, greedy_action, evaluate)
+        elif serve:
+            if fused:
+                serve_agent(env, agent.model, lambda pi_v: sample_action(pi_v[0]), serve)
+            else:
+                serve_agent(env, agent.actor, sample_action, serve)
+        elif train and envs:
+            train_vector_agent(vector_envs.make('LunarLander-v2', envs, asynchronous), agent)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.model if fused else agent.actor, greedy_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "return", -np.inf)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
@@ -5,13 +5,27 @@ import numpy as np
 import os
 import pickle
 import random
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.distributions import Normal
+
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, mean_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import autocast, compile_learner, warmup_learner
+from noise_pool import NoisePool
+from policy_compression import quantize_policy, quantize_agent
+from learner_thread import LearnerThread
+import vector_envs
 
 SAVE_FILE_PATH = "MountainCar-DDPG.torch"
+EXPORT_FILE_PATH = "MountainCar-DDPG.npz"
+QUANTIZED_FILE_PATH = "MountainCar-DDPG-int8.torch"
+SHARED_WEIGHTS_NAME = "MountainCar-DDPG-weights"
 
 # if gpu is used
 device = ("cuda" if torch.cuda.is_available() else "cpu")
@@ -96,7 +110,9 @@ class DDPG:
     update = 0
     noise = 1.0
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, bf16=False, compile=False):
+
+        self.bf16 = bf16
 
         self.q = Q(inputs, outputs).to(device)
         self.pi = Policy(inputs, outputs).to(device)
@@ -110,21 +126,54 @@ class DDPG:
         self.optimizer_q = optim.Adam(self.q.parameters(), lr=self.ALPHA)
         self.optimizer_pi = optim.Adam(self.pi.parameters(), lr=self.ALPHA)
 
-    def action(self, s, use_noise=False):
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(1, inputs, device=device)
 
-        with torch.no_grad():
-            pi = self.pi(torch.as_tensor(s).float().to(device)).cpu()
+        # Exploration noise drawn by blocks, scaled by the current level
+        self.noise_pool = NoisePool(outputs)
+
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
+
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
+
+    def action(self, s, use_noise=False, pi=None):
+
+        # Another copy of the policy can be given, the snapshot of the
+        # learner thread for instance
+        if pi is None:
+            pi = self.pi
+
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+            a = pi(self.input_buffer).cpu().numpy()[0]
 
         if use_noise:
 
-            pi = Normal(pi, self.noise).sample()
+            a += self.noise_pool.sample(self.noise)
 
             if self.noise > self.NOISE_MIN:
                 self.noise -= self.NOISE_DECAY
 
-        a = pi.cpu()
+        return np.clip(a, -1.0, 1.0, out=a)
+
+    def actions(self, states, use_noise=False):
 
-        return a.clamp(-1.0, 1.0)
+        # One forward pass gives the actions of all the environments
+        with torch.inference_mode():
+            a = self.pi(torch.as_tensor(states, device=device)).cpu().numpy()
+
+        if use_noise:
+
+            a += self.noise_pool.samples(len(a), self.noise)
+
+            # Decrease the noise once per step of the environments
+            if self.noise > self.NOISE_MIN:
+                self.noise -= self.NOISE_DECAY
+
+        return np.clip(a, -1.0, 1.0, out=a)
 
     def store(self, *args):
 
@@ -134,72 +183,98 @@ class DDPG:
         if len(self.memory) > self.MEMORY_SIZE:
             self.memory.pop(0)
 
+    def store_batch(self, states, next_states, rewards, actions, done):
+
+        self.memory.extend(map(self.experience, states, next_states,
+                               rewards.tolist(), actions, done.tolist()))
+
+        if len(self.memory) > self.MEMORY_SIZE:
+            del self.memory[:len(self.memory) - int(self.MEMORY_SIZE)]
+
     def train(self):
 
+        # Tell the learner thread whether the networks were updated
         if len(self.memory) < self.BATCH_SIZE:
-            return
+            return False
 
         self.update += 1
 
         # Train the network each UPDATE episode
         if self.update % self.UPDATE != 0:
-            return
+            return False
 
         samples = random.sample(self.memory, self.BATCH_SIZE)
         batch = self.experience(*zip(*samples))
 
         states = torch.as_tensor(np.float32(batch.s), device=device)
         next_states = torch.as_tensor(np.float32(batch.s2), device=device)
-        actions = torch.zeros([self.BATCH_SIZE, 1], device=device)
-        rewards = torch.as_tensor(batch.r, device=device)
-        done = torch.as_tensor(batch.done, device=device)
+        actions = torch.as_tensor(np.float32(batch.a), device=device).view(-1, 1)
+        rewards = torch.as_tensor(np.float32(batch.r), device=device).view(-1, 1)
+        done = torch.as_tensor(np.float32(batch.done), device=device).view(-1, 1)
 
-        y = torch.zeros([self.BATCH_SIZE, 1], device=device)
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, done))
+            self.warm = True
 
-        q = self.q(states, actions)
+        self.learner(states, next_states, actions, rewards, done)
 
-        with torch.no_grad():
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
 
-            pi2 = self.pi_target(torch.as_tensor(next_states).float())
+        return True
 
-            q2 = self.q_target(next_states, pi2)
+    def learn(self, states, next_states, actions, rewards, done):
 
-            for i in range(self.BATCH_SIZE):
+        with autocast(self.bf16):
+            q = self.q(states, actions).float()
 
-                if done[i]:
-                    y[i] = rewards[i]
-                else:
-                    y[i] = rewards[i] + self.GAMMA * q2[i]
+        with torch.no_grad(), autocast(self.bf16):
+
+            pi2 = self.pi_target(next_states)
+
+            q2 = self.q_target(next_states, pi2).float()
+
+            y = rewards + self.GAMMA * q2 * (1.0 - done)
 
-        self.optimizer_q.zero_grad()
         q_loss = torch.nn.MSELoss()(q, y)
+
+        self.optimizer_q.zero_grad()
         q_loss.backward()
         self.optimizer_q.step()
 
-        pi = self.pi(torch.as_tensor(states).float())
+        with autocast(self.bf16):
+            pi_loss = - self.q(states, self.pi(states)).float().mean()
 
         self.optimizer_pi.zero_grad()
-        pi_loss = - self.q(states, pi).mean()
         pi_loss.backward()
         self.optimizer_pi.step()
 
         # Update target network
-        for target_param, source_param in zip(self.q_target.parameters(), self.q.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+        with torch.no_grad():
+
+            for target_param, source_param in zip(self.q_target.parameters(), self.q.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-        for target_param, source_param in zip(self.pi_target.parameters(), self.pi.parameters()):
-            target_param.data.copy_(
-                target_param.data * (1.0 - self.POLYAK) + \
-                source_param.data * self.POLYAK)
+            for target_param, source_param in zip(self.pi_target.parameters(), self.pi.parameters()):
+                target_param.copy_(
+                    target_param * (1.0 - self.POLYAK) + \
+                    source_param * self.POLYAK)
 
-def play_agent(env, agent):
+def play_agent(env, agent, weights=None, limit=0):
 
     episode = 0
     steps = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episode < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         steps = 0
         s = env.reset()
@@ -222,10 +297,12 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = np.full(100, 200).tolist()
+    total_steps = 0
+    start = time.perf_counter()
 
     while 1:
 
@@ -255,6 +332,82 @@ def train_agent(env, agent):
             agent.store(s, s2, r , a, done)
             agent.train()
 
+            total_steps += 1
+
+            s = s2
+
+            if done:
+                # Calcul the score total over 100 episodes
+                results.append(steps)
+                if len(results) > 100:
+                    results.pop(0)
+
+                score = np.sum(np.asarray(results)) / 100
+
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
+                if score < 170:
+                    save_agent(agent)
+                    print("Finished!!!")
+                    exit()
+
+                episode += 1
+
+                print("Episode", episode,
+                      "finished after", rewards, steps,
+                      "score", score,
+                      "steps/s", round(total_steps / (time.perf_counter() - start), 1))
+
+                # Save the state of the agent
+                if episode % 20 == 0:
+                    save_agent(agent)
+
+                break
+
+def train_threaded_agent(env, agent, update_ratio):
+
+    episode = 0
+    results = np.full(100, 200).tolist()
+    total_steps = 0
+    start = time.perf_counter()
+
+    # The updates run in their own thread, at most update_ratio per step
+    learner = LearnerThread(agent, agent.pi, update_ratio)
+
+    while 1:
+
+        rewards = 0
+        lags = []
+        steps = 0
+        s = env.reset()
+
+        while 1:
+
+            # Act with the newest snapshot of the policy
+            a, lag = learner.act(lambda pi: agent.action(s, True, pi))
+            lags.append(lag)
+            s2, r, done, _ = env.step(a)
+
+            # if s2[0] >= 0.5:
+            #     r += 100
+            # elif s2[0] >= 0.25:
+            #     r += 20
+            # elif s2[0] >= 0.1:
+            #     r += 10
+            # elif s2[0] >= -0.1:
+            #     r += 2
+            # elif s2[0] >= -0.25:
+            #     r += 1
+
+            rewards += r
+            steps += 1
+
+            learner.store(s, s2, r, a, done)
+
+            total_steps += 1
+
             s = s2
 
             if done:
@@ -266,11 +419,8 @@ def train_agent(env, agent):
                 score = np.sum(np.asarray(results)) / 100
 
                 if score < 170:
-                    torch.save((
-                        agent.q.state_dict(), \
-                        agent.q_target.state_dict(), \
-                        agent.pi.state_dict(), \
-                        agent.pi_target.state_dict()), SAVE_FILE_PATH)
+                    with learner.lock:
+                        save_agent(agent)
                     print("Finished!!!")
                     exit()
 
@@ -278,26 +428,202 @@ def train_agent(env, agent):
 
                 print("Episode", episode,
                       "finished after", rewards, steps,
-                      "score", score)
+                      "score", score,
+                      "steps/s", round(total_steps / (time.perf_counter() - start), 1),
+                      "updates/s", round(learner.updates / (time.perf_counter() - start), 1),
+                      "policy lag", round(np.mean(lags), 1))
 
                 # Save the state of the agent
                 if episode % 20 == 0:
-                    torch.save((
-                        agent.q.state_dict(), \
-                        agent.q_target.state_dict(), \
-                        agent.pi.state_dict(), \
-                        agent.pi_target.state_dict()), SAVE_FILE_PATH)
+                    with learner.lock:
+                        save_agent(agent)
 
                 break
 
+def train_vector_agent(envs, agent):
+
+    episode = 0
+    results = np.full(100, 200).tolist()
+    rewards = np.zeros(envs.num_envs)
+    steps = np.zeros(envs.num_envs, dtype=int)
+    total_steps = 0
+
+    start = time.perf_counter()
+    s = envs.reset()
+
+    while 1:
+
+        a = agent.actions(s, True)
+        s2, r, done, infos = envs.step(a)
+
+        # The finished environments are already reset, their last state is
+        # kept in the info
+        next_states = vector_envs.final_observations(s2, done, infos)
+
+        agent.store_batch(s, next_states, r, a, done)
+        agent.train()
+
+        s = s2
+
+        rewards += r
+        steps += 1
+        total_steps += envs.num_envs
+
+        for i in np.flatnonzero(done):
+
+            # Calcul the score total over 100 episodes of all the environments
+            results.append(steps[i])
+            if len(results) > 100:
+                results.pop(0)
+
+            score = np.sum(np.asarray(results)) / 100
+
+            if score < 170:
+                save_agent(agent)
+                print("Finished!!!")
+                exit()
+
+            episode += 1
+
+            print("Episode", episode,
+                  "finished after", rewards[i], steps[i],
+                  "score", score,
+                  "steps/s", round(total_steps / (time.perf_counter() - start), 1))
+
+            rewards[i] = 0
+            steps[i] = 0
+
+            # Save the state of the agent
+            if episode % 20 == 0:
+                save_agent(agent)
+
+def benchmark_agent(env):
+
+    BENCH_TRANSITIONS = 1000
+    BENCH_UPDATES = 200
+    BENCH_ACTIONS = 10000
+
+    # Record random transitions shared by both precisions
+    s = env.reset()
+
+    for i in range(BENCH_TRANSITIONS):
+
+        a = env.action_space.sample().tolist()
+        s2, r, done, _ = env.step(a)
+
+        DDPG.memory.append(DDPG.experience(s, s2, r, a, done))
+
+        s = s2
+
+        if done:
+            s = env.reset()
+
+    for bf16 in [False, True]:
+
+        agent = DDPG(env.observation_space.shape[0], env.action_space.shape[0], bf16)
+
+        # Warm up before timing
+        for i in range(10):
+            agent.train()
+
+        start = time.perf_counter()
+        for i in range(BENCH_UPDATES):
+            agent.train()
+        elapsed = time.perf_counter() - start
+
+        print("Precision", "bfloat16" if bf16 else "float32",
+              "updates/s", round(BENCH_UPDATES / elapsed, 1))
+
+    # Time the actions with the exploration noise as during the training
+    agent = DDPG(env.observation_space.shape[0], env.action_space.shape[0])
+    states = [experience.s for experience in DDPG.memory]
+
+    # Warm up before timing
+    for i in range(100):
+        agent.action(states[i], True)
+
+    start = time.perf_counter()
+    for i in range(BENCH_ACTIONS):
+        agent.action(states[i % len(states)], True)
+    elapsed = time.perf_counter() - start
+
+    print("Action latency", round(elapsed / BENCH_ACTIONS * 1e6, 1), "us")
+
+def save_agent(agent):
+
+    torch.save((
+        agent.q.state_dict(), \
+        agent.q_target.state_dict(), \
+        agent.pi.state_dict(), \
+        agent.pi_target.state_dict()), SAVE_FILE_PATH)
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    pi = agent.pi
+
+    program = [
+        ("linear", dict(pi.h1.named_parameters())),
+        ("layernorm", dict(pi.norm1.named_parameters(), eps=pi.norm1.eps)),
+        ("relu", {}),
+        ("linear", dict(pi.h2.named_parameters())),
+        ("layernorm", dict(pi.norm2.named_parameters(), eps=pi.norm2.eps)),
+        ("relu", {}),
+        ("linear", dict(pi.pi.named_parameters())),
+        ("tanh", {}),
+        ("clip", {"low": -1.0, "high": 1.0})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            expected = agent.pi(torch.as_tensor(np.float32(s), device=device))
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, EXPORT_FILE_PATH, QUANTIZED_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--quantize', flag_value='quantize', default=False)
+@click.option('--bf16', is_flag=True, default=False)
+@click.option('--int8', is_flag=True, default=False)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--envs', type=int, default=0)
+@click.option('--asynchronous', is_flag=True, default=False)
+@click.option('--threaded', is_flag=True, default=False)
+@click.option('--update-ratio', type=float, default=1.0)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, quantize, bf16, int8, compile, publish, follow, envs, asynchronous, threaded, update_ratio, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -306,25 +632,85 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('MountainCarContinuous-v0')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = DDPG(env.observation_space.shape[0], env.action_space.shape[0])
+    agent = DDPG(env.observation_space.shape[0], env.action_space.shape[0], bf16, compile)
+
+    loaded = False
 
     try:
-        # q, q_target, pi, pi_target = torch.load(SAVE_FILE_PATH)
-        # agent.q.load_state_dict(q)
-        # agent.q_target.load_state_dict(q_target)
-        # agent.pi.load_state_dict(pi)
-        # agent.pi_ta<rget.load_state_dict(pi_target)
+        q, q_target, pi, pi_target = torch.load(SAVE_FILE_PATH)
+        agent.q.load_state_dict(q)
+        agent.q_target.load_state_dict(q_target)
+        agent.pi.load_state_dict(pi)
+        agent.pi_target.load_state_dict(pi_target)
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        agent.q.eval()
-        agent.pi.eval()
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and (export or quantize):
+        raise click.ClickException("No agent saved in %s, train one first" % SAVE_FILE_PATH)
+
+    # Play with the int8 policy saved by --quantize
+    if int8:
+        agent.pi = quantize_policy(agent.pi)
+        agent.pi.load_state_dict(torch.load(QUANTIZED_FILE_PATH))
+        agent.input_buffer = agent.input_buffer.cpu()
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, publish)
+
+    try:
+        if play:
+            agent.q.eval()
+            agent.pi.eval()
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.pi) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.pi, mean_action, evaluate)
+        elif serve:
+            serve_agent(env, agent.pi, lambda a: a, serve)
+        elif quantize:
+            quantize_agent(env, agent, QUANTIZED_FILE_PATH)
+        elif train and envs:
+            train_vector_agent(vector_envs.make('MountainCarContinuous-v0', envs, asynchronous), agent)
+        elif train and threaded:
+            train_threaded_agent(env, agent, update_ratio)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.pi, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.pi, mean_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "length", np.inf)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
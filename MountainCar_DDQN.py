@@ -5,13 +5,28 @@ import numpy as np
 import os
 import pickle
 import random
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.distributions import Categorical
 
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, greedy_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import compile_learner, warmup_learner
+import vector_envs
+
 SAVE_FILE_PATH = "MoutainCar_DDQN.torch"
+EXPORT_FILE_PATH = "MountainCar-DDQN.npz"
+SHARED_WEIGHTS_NAME = "MountainCar-DDQN-weights"
+
+# Bonus added to the reward from each position, the highest first
+SHAPING_POSITIONS = [0.5, 0.25, 0.1, -0.1, -0.25]
+SHAPING_BONUSES = [100, 20, 10, 2, 1]
 
 # if gpu is used
 device = "cpu"#("cuda" if torch.cuda.is_available() else "cpu")
@@ -38,6 +53,7 @@ class DDQN:
     EPSILON = 1.0
     EPSILON_MIN = 0.01
     EPSILON_DECAY = 0.995
+    EPSILON_SPREAD = 2
     BATCH_SIZE = 32
     TARGET_UPDATE = 10
     MEMORY_SIZE = 5000.0
@@ -48,7 +64,9 @@ class DDQN:
     memory = []
     experience = namedtuple('Experience', ('s', 's2', 'r', 'a', 'done'))
 
-    def __init__(self, inputs, outputs):
+    def __init__(self, inputs, outputs, compile=False):
+
+        self.outputs = outputs
 
         self.policy = Model(inputs, outputs).to(device)
         self.target = Model(inputs, outputs).to(device)
@@ -58,17 +76,29 @@ class DDQN:
 
         self.optimizer = optim.Adam(self.policy.parameters(), lr=self.ALPHA)
 
-    def action(self, s):
+        self.batch_index = torch.arange(self.BATCH_SIZE, device=device)
 
-        with torch.no_grad():
-            q = self.policy(torch.as_tensor(np.float32(s)).to(device)).cpu()
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(inputs, device=device)
 
-        # e-Greedy explore
-        greedy = np.full(len(q), self.epsilon / (len(q)-1))
-        greedy[np.argmax(q)] = 1.0 - self.epsilon
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
 
-        # Get a random action
-        a = np.random.choice(len(q), 1, p=greedy.flatten())[0]
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
+
+    def action(self, s):
+
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+            a = int(self.policy(self.input_buffer).argmax())
+
+        # e-Greedy explore, a single draw decides to explore and the random
+        # action is then picked among the other actions
+        if random.random() < self.epsilon:
+            other = random.randrange(self.outputs - 1)
+            a = other + (other >= a)
 
         # Decrease the exploration rate
         if self.epsilon > self.EPSILON_MIN:
@@ -78,6 +108,29 @@ class DDQN:
 
         return a
 
+    def actions(self, states):
+
+        n = len(states)
+
+        # One forward pass picks the greedy actions of all the environments
+        with torch.inference_mode():
+            q = self.policy(torch.as_tensor(states, device=device))
+            a = q.argmax(1).cpu().numpy()
+
+        # Every environment explores at its own rate, the first one follows
+        # the schedule and the last one explores the least
+        epsilons = self.epsilon ** (1 + np.arange(n) / max(n - 1, 1) * self.EPSILON_SPREAD)
+        other = np.random.randint(self.outputs - 1, size=n)
+        a = np.where(np.random.random(n) < epsilons, other + (other >= a), a)
+
+        # Decrease the exploration rate once per step of the environments
+        if self.epsilon > self.EPSILON_MIN:
+            self.epsilon *= self.EPSILON_DECAY
+        else:
+            self.epsilon = self.EPSILON_MIN
+
+        return a
+
     def store(self, *args):
 
         self.memory.append(self.experience(*args))
@@ -86,6 +139,14 @@ class DDQN:
         if len(self.memory) > self.MEMORY_SIZE:
             self.memory.pop(0)
 
+    def store_batch(self, states, next_states, rewards, actions, done):
+
+        self.memory.extend(map(self.experience, states, next_states,
+                               rewards.tolist(), actions.tolist(), done.tolist()))
+
+        if len(self.memory) > self.MEMORY_SIZE:
+            del self.memory[:len(self.memory) - int(self.MEMORY_SIZE)]
+
     def train(self):
 
         if len(self.memory) < self.BATCH_SIZE:
@@ -97,36 +158,51 @@ class DDQN:
         states = torch.as_tensor(np.float32(batch.s), device=device)
         next_states = torch.as_tensor(np.float32(batch.s2), device=device)
         actions = torch.as_tensor(batch.a, device=device)
-        rewards = torch.as_tensor(batch.r, device=device)
-        done = torch.as_tensor(batch.done, device=device)
+        rewards = torch.as_tensor(np.float32(batch.r), device=device)
+        done = torch.as_tensor(np.float32(batch.done), device=device)
+
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, done))
+            self.warm = True
+
+        self.learner(states, next_states, actions, rewards, done)
+
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
+
+        self.target_update += 1
+
+        if self.target_update % self.TARGET_UPDATE == 0:
+            self.target.load_state_dict(self.policy.state_dict())
+
+    def learn(self, states, next_states, actions, rewards, done):
 
         q = self.policy(states)
         q2 = self.target(next_states).detach()
-        qtarget = q.clone()
+        qtarget = q.detach().clone()
 
-        for i in range(self.BATCH_SIZE):
-
-            if done[i]:
-                qtarget[i, actions[i]] = rewards[i]
-            else:
-                qtarget[i, actions[i]] = rewards[i] + self.GAMMA * torch.max(q2[i])
+        # Only the Q value of the action taken moves toward its target
+        qtarget[self.batch_index, actions] = \
+            rewards + self.GAMMA * torch.max(q2, 1)[0] * (1.0 - done)
 
         loss = torch.nn.MSELoss()(q, qtarget)
         self.optimizer.zero_grad()
         loss.backward()
         self.optimizer.step()
 
-        self.target_update += 1
-
-        if self.target_update % self.TARGET_UPDATE == 0:
-            self.target.load_state_dict(self.policy.state_dict())
-
-def play_agent(env, agent):
+def play_agent(env, agent, weights=None, limit=0):
 
     episode = 0
     steps = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episode < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         steps = 0
         s = env.reset()
@@ -149,7 +225,17 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def shape_rewards(positions, rewards):
+
+    # Reward the cars for climbing, each one gets the bonus of the highest
+    # position it reached. The positions are compared in float64 as with
+    # a single state
+    positions = np.asarray(positions, dtype=np.float64)
+    bonuses = np.select([positions >= position for position in SHAPING_POSITIONS], SHAPING_BONUSES)
+
+    return rewards + bonuses
+
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = np.full(100, 200).tolist()
@@ -164,16 +250,7 @@ def train_agent(env, agent):
             a = agent.action(s)
             s2, r, done, _ = env.step(a)
 
-            if s2[0] >= 0.5:
-                r += 100
-            elif s2[0] >= 0.25:
-                r += 20
-            elif s2[0] >= 0.1:
-                r += 10
-            elif s2[0] >= -0.1:
-                r += 2
-            elif s2[0] >= -0.25:
-                r += 1
+            r = float(shape_rewards(s2[0], r))
 
             agent.store(s, s2, r, a, done)
             agent.train()
@@ -191,6 +268,10 @@ def train_agent(env, agent):
 
                 score = np.sum(np.asarray(results)) / 100
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score < 170:
                     print("Finished!!!")
                     torch.save(agent.policy.state_dict(), SAVE_FILE_PATH)
@@ -208,14 +289,144 @@ def train_agent(env, agent):
 
                 break
 
+def train_vector_agent(envs, agent):
+
+    episode = 0
+    results = np.full(100, 200).tolist()
+    steps = np.zeros(envs.num_envs, dtype=int)
+    env_steps = 0
+
+    start = time.perf_counter()
+    s = envs.reset()
+
+    while 1:
+
+        a = agent.actions(s)
+        s2, r, done, infos = envs.step(a)
+
+        # The finished environments are already reset, their last state is
+        # kept in the info
+        next_states = vector_envs.final_observations(s2, done, infos)
+
+        agent.store_batch(s, next_states, shape_rewards(next_states[:, 0], r), a, done)
+        agent.train()
+
+        s = s2
+
+        steps += 1
+        env_steps += envs.num_envs
+
+        for i in np.flatnonzero(done):
+
+            # Calcul the score total over 100 episodes of all the environments
+            results.append(steps[i])
+            if len(results) > 100:
+                results.pop(0)
+
+            score = np.sum(np.asarray(results)) / 100
+
+            if score < 170:
+                print("Finished!!!")
+                torch.save(agent.policy.state_dict(), SAVE_FILE_PATH)
+                exit()
+
+            episode += 1
+
+            print("Episode", episode,
+                  "finished after", steps[i],
+                  "timesteps, score", score,
+                  "env steps/s", round(env_steps / (time.perf_counter() - start), 1))
+
+            steps[i] = 0
+
+            # Save the state of the agent
+            if episode % 20 == 0:
+                torch.save(agent.policy.state_dict(), SAVE_FILE_PATH)
+
+def benchmark_agent(env):
+
+    BENCH_ACTIONS = 10000
+
+    # Record the states of random episodes
+    states = []
+    s = env.reset()
+
+    for i in range(1000):
+
+        states.append(s)
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    agent = DDQN(env.observation_space.shape[0], env.action_space.n)
+
+    # Warm up before timing
+    for i in range(100):
+        agent.action(states[i])
+
+    start = time.perf_counter()
+    for i in range(BENCH_ACTIONS):
+        agent.action(states[i % len(states)])
+    elapsed = time.perf_counter() - start
+
+    print("Action latency", round(elapsed / BENCH_ACTIONS * 1e6, 1), "us")
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    program = [
+        ("linear", dict(agent.policy.h1.named_parameters())),
+        ("relu", {}),
+        ("linear", dict(agent.policy.q.named_parameters())),
+        ("argmax", {})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            expected = agent.policy(torch.as_tensor(np.float32(s), device=device))
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, EXPORT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--envs', type=int, default=0)
+@click.option('--asynchronous', is_flag=True, default=False)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, compile, publish, follow, envs, asynchronous, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -224,22 +435,72 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('MountainCar-v0')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
-    agent = DDQN(env.observation_space.shape[0], env.action_space.n)
+    agent = DDQN(env.observation_space.shape[0], env.action_space.n, compile)
+
+    loaded = False
 
     try:
         agent.policy.load_state_dict(torch.load(SAVE_FILE_PATH))
-        agent.target.load_state_dict(self.policy.state_dict())
+        agent.target.load_state_dict(agent.policy.state_dict())
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        agent.policy.eval()
-        agent.target.eval()
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and export:
+        raise click.ClickException("No agent saved in %s, train one first" % SAVE_FILE_PATH)
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.policy, publish)
+
+    try:
+        if play:
+            agent.policy.eval()
+            agent.target.eval()
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.policy) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.policy, greedy_action, evaluate)
+        elif serve:
+            serve_agent(env, agent.policy, lambda q: int(np.argmax(q)), serve)
+        elif train and envs:
+            train_vector_agent(vector_envs.make('MountainCar-v0', envs, asynchronous), agent)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.policy, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.policy, greedy_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "length", np.inf)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
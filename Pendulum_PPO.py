@@ -5,16 +5,29 @@ import numpy as np
 import os
 import pickle
 import random
+import time
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 from torch.distributions import Normal
 
+from numpy_policy import NumpyPolicy, save_policy
+from policy_server import serve_agent
+from evaluation import evaluate_agent, mean_action, AsyncEvaluator, PUBLISH_INTERVAL
+from shared_weights import WeightPublisher, WeightSubscriber
+from frame_recorder import FrameRecorder
+from compile_utils import compile_learner, warmup_learner
+import vector_envs
+
 # References:
 # https://arxiv.org/abs/1707.06347
 
 SAVE_FILE_PATH = "Pendulum-PPO.torch"
+# One file by layout of the fused layers, their state_dicts differ
+FUSED_SAVE_FILE_PATH = "Pendulum-PPO-fused-%s.torch"
+EXPORT_FILE_PATH = "Pendulum-PPO.npz"
+SHARED_WEIGHTS_NAME = "Pendulum-PPO-weights"
 
 class Actor(nn.Module):
 
@@ -56,6 +69,42 @@ class Critic(nn.Module):
         x = F.relu(self.h1(x))
         return self.v(x)
 
+class ActorCritic(nn.Module):
+
+    HIDDEN_LAYER_SIZE = 128
+
+    def __init__(self, inputs, outputs_range, shared=False):
+        super(ActorCritic, self).__init__()
+
+        self.scale = torch.tensor((outputs_range[1] - outputs_range[0]) / 2.0)
+        self.shared = shared
+
+        # The first layers of the mean and std towers and of the critic are
+        # fused in one wider layer, either shared by the three heads or split
+        # between them
+        if shared:
+            self.h1 = nn.Linear(inputs, self.HIDDEN_LAYER_SIZE)
+        else:
+            self.h1 = nn.Linear(inputs, 3 * self.HIDDEN_LAYER_SIZE)
+
+        self.pi_mean = nn.Linear(self.HIDDEN_LAYER_SIZE, 1)
+        self.pi_std = nn.Linear(self.HIDDEN_LAYER_SIZE, 1)
+        self.v = nn.Linear(self.HIDDEN_LAYER_SIZE, 1)
+
+    def forward(self, x):
+
+        x = F.relu(self.h1(x))
+
+        if self.shared:
+            x_mean, x_std, x_v = x, x, x
+        else:
+            x_mean, x_std, x_v = x.split(self.HIDDEN_LAYER_SIZE, dim=-1)
+
+        mean = torch.tanh(self.pi_mean(x_mean)) * self.scale
+        std = F.softplus(self.pi_std(x_std))
+
+        return mean, std, self.v(x_v)
+
 class PPO:
 
     ALPHA = 5e-5
@@ -73,25 +122,63 @@ class PPO:
     memory = []
     update = 0
 
-    def __init__(self, inputs, outputs_range):
+    def __init__(self, inputs, outputs_range, fused=None, compile=False):
 
         self.outputs_range = [outputs_range[0][0], outputs_range[1][0]]
+        self.fused = fused
+
+        if fused:
+            self.model = ActorCritic(inputs, outputs_range, fused == 'shared')
+            self.optimizer = torch.optim.Adam(self.model.parameters(), lr=self.ALPHA)
+        else:
+            self.actor = Actor(inputs, outputs_range)
+            self.critic = Critic(inputs)
+
+            self.optimizer_actor = torch.optim.Adam(self.actor.parameters(), lr=self.ALPHA)
+            self.optimizer_critic = torch.optim.Adam(self.critic.parameters(), lr=self.ALPHA)
+
+        # The states are copied into this buffer instead of a new tensor
+        # at every action
+        self.input_buffer = torch.zeros(inputs)
 
-        self.actor = Actor(inputs, outputs_range)
-        self.critic = Critic(inputs)
+        # Set by --publish to share the weights after the updates
+        self.publisher = None
 
-        self.optimizer_actor = torch.optim.Adam(self.actor.parameters(), lr=self.ALPHA)
-        self.optimizer_critic = torch.optim.Adam(self.critic.parameters(), lr=self.ALPHA)
+        self.learner = compile_learner(self.learn) if compile else self.learn
+        self.warm = not compile
 
     def action(self, s):
 
-        with torch.no_grad():
-            pi_mean, pi_std = self.actor(torch.as_tensor(s).float())
+        with torch.inference_mode():
+            self.input_buffer.copy_(torch.as_tensor(s))
+
+            if self.fused:
+                pi_mean, pi_std, _ = self.model(self.input_buffer)
+            else:
+                pi_mean, pi_std = self.actor(self.input_buffer)
+
+            # The parameters come from the network, no need to validate them
+            pi = Normal(pi_mean, pi_std, validate_args=False)
+            a = pi.sample()
 
-        pi = Normal(pi_mean, pi_std)
-        a = pi.sample()
+            return a.clamp(self.outputs_range[0], self.outputs_range[1]), pi.log_prob(a)
 
-        return a.clamp(self.outputs_range[0], self.outputs_range[1]), pi.log_prob(a)
+    def actions(self, states):
+
+        # One forward pass and one distribution give the actions and their
+        # log probabilities for all the environments
+        with torch.inference_mode():
+            x = torch.as_tensor(states)
+
+            if self.fused:
+                pi_mean, pi_std, _ = self.model(x)
+            else:
+                pi_mean, pi_std = self.actor(x)
+
+            pi = Normal(pi_mean, pi_std, validate_args=False)
+            a = pi.sample()
+
+            return a.clamp(self.outputs_range[0], self.outputs_range[1]).numpy(), pi.log_prob(a).numpy()
 
     def store(self, *args):
 
@@ -101,6 +188,14 @@ class PPO:
         if len(self.memory) > self.MEMORY_SIZE:
             self.memory.pop(0)
 
+    def store_batch(self, states, next_states, rewards, actions, done, log_probs):
+
+        self.memory.extend(map(self.experience, states, next_states,
+                               rewards.tolist(), actions, done.tolist(), log_probs))
+
+        if len(self.memory) > self.MEMORY_SIZE:
+            del self.memory[:len(self.memory) - int(self.MEMORY_SIZE)]
+
     def train(self):
 
         if len(self.memory) < self.BATCH_SIZE:
@@ -115,42 +210,55 @@ class PPO:
         samples = random.sample(self.memory, self.BATCH_SIZE)
         batch = self.experience(*zip(*samples))
 
-        states = torch.as_tensor(batch.s).float()
-        next_states = torch.as_tensor(batch.s2).float()
-        actions = torch.as_tensor(batch.a)
-        rewards = torch.as_tensor(batch.r)
-        done = torch.as_tensor(batch.done)
-        q = torch.zeros([self.BATCH_SIZE, 1])
-        old_log_prob = torch.as_tensor(batch.old_log_prob)
+        states = torch.as_tensor(np.float32(batch.s))
+        next_states = torch.as_tensor(np.float32(batch.s2))
+        actions = torch.as_tensor(np.float32(batch.a)).view(-1, 1)
+        rewards = torch.as_tensor(np.float32(batch.r)).view(-1, 1)
+        old_log_prob = torch.as_tensor(np.float32(batch.old_log_prob)).view(-1, 1)
+
+        # Compile before the first update
+        if not self.warm:
+            warmup_learner(self, lambda: self.learner(states, next_states, actions, rewards, old_log_prob))
+            self.warm = True
+
+        self.learner(states, next_states, actions, rewards, old_log_prob)
+
+        # Share the new weights with the play processes
+        if self.publisher:
+            self.publisher.update()
+
+    def learn(self, states, next_states, actions, rewards, old_log_prob):
 
         with torch.no_grad():
 
-            v2 = self.critic(next_states).detach()
-            v = self.critic(states)
+            if self.fused:
+                _, _, v = self.model(torch.cat((states, next_states)))
+                v2 = v[self.BATCH_SIZE:]
+                v = v[:self.BATCH_SIZE]
+            else:
+                v2 = self.critic(next_states).detach()
+                v = self.critic(states)
 
             # The terminal state is not considered as it doesn't change from
             # the other state
-            for i in range(self.BATCH_SIZE):
-                q[i] = rewards[i] + self.GAMMA * v2[i]
+            q = rewards + self.GAMMA * v2
 
             adv = (q - v)
 
         for i in range(self.EPOCH):
 
-            surr = torch.zeros(self.BATCH_SIZE)
-            entropy = torch.zeros(self.BATCH_SIZE)
-
-            pi_mean, pi_std = self.actor(states)
-            v = self.critic(states)
-
-            for y in range(self.BATCH_SIZE):
+            if self.fused:
+                pi_mean, pi_std, v = self.model(states)
+            else:
+                pi_mean, pi_std = self.actor(states)
+                v = self.critic(states)
 
-                pi = Normal(pi_mean[y], pi_std[y])
-                entropy[y] = pi.entropy()
+            pi = Normal(pi_mean, pi_std)
+            entropy = pi.entropy()
 
-                ratio = torch.exp(pi.log_prob(actions[y]) - (old_log_prob[y] + 1e-10))
-                clip = ratio.clamp(1.0 - self.EPSILON, 1.0 + self.EPSILON)
-                surr[y] = torch.min(ratio * adv[y], clip * adv[y])
+            ratio = torch.exp(pi.log_prob(actions) - (old_log_prob + 1e-10))
+            clip = ratio.clamp(1.0 - self.EPSILON, 1.0 + self.EPSILON)
+            surr = torch.min(ratio * adv, clip * adv)
 
             loss_critic = torch.nn.MSELoss()(v, q)
             loss_critic_detached = loss_critic.clone().detach()
@@ -160,20 +268,31 @@ class PPO:
                 self. VALUE * loss_critic_detached - \
                 self.ENTROPY * entropy.mean()
 
-            self.optimizer_critic.zero_grad()
-            loss_critic.backward()
-            self.optimizer_critic.step()
+            if self.fused:
+                self.optimizer.zero_grad()
+                (loss_actor + loss_critic).backward()
+                self.optimizer.step()
+                continue
 
+            # The actor and the critic don't share any parameter, a single
+            # backward through both losses gives each one its own gradients
+            self.optimizer_critic.zero_grad()
             self.optimizer_actor.zero_grad()
-            loss_actor.backward()
+            (loss_actor + loss_critic).backward()
+            self.optimizer_critic.step()
             self.optimizer_actor.step()
 
-def play_agent(env, agent):
+def play_agent(env, agent, weights=None, limit=0):
 
     results = []
     episodes = 0
 
-    while 1:
+    # Play forever, or the given number of episodes
+    while not limit or episodes < limit:
+
+        # Pick up the newest weights published by the training
+        if weights and weights.poll():
+            print("Weights version", weights.version)
 
         steps = 0
         s = env.reset()
@@ -195,7 +314,7 @@ def play_agent(env, agent):
 
                 break
 
-def train_agent(env, agent):
+def train_agent(env, agent, evaluator=None):
 
     episode = 0
     results = np.full(100, -2000).tolist()
@@ -229,9 +348,13 @@ def train_agent(env, agent):
 
                 score = np.sum(np.asarray(results)) / 100
 
+                # Stop on the noise-free scores of the evaluator when it runs
+                if evaluator:
+                    score = evaluator.poll()
+
                 if score >= -300:
                     print("Finished!!!")
-                    torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
                     exit()
 
                 episode += 1
@@ -242,18 +365,193 @@ def train_agent(env, agent):
 
                 # Save the state of the agent
                 if episode % 20 == 0:
-                    torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+                    save_agent(agent)
 
                 break
 
+def train_vector_agent(envs, agent):
+
+    episode = 0
+    results = np.full(100, -2000).tolist()
+    rewards = np.zeros(envs.num_envs)
+    env_steps = 0
+
+    start = time.perf_counter()
+    s = envs.reset()
+
+    while 1:
+
+        a, log_prob = agent.actions(s)
+        s2, r, done, infos = envs.step(a)
+
+        # The finished environments are already reset, their last state is
+        # kept in the info
+        next_states = vector_envs.final_observations(s2, done, infos)
+
+        rewards += r
+
+        # reward betweem -16.2736044 to 0
+        agent.store_batch(s, next_states, (r / 16.2736044) + 0.5, a, done, log_prob)
+        agent.train()
+
+        s = s2
+
+        env_steps += envs.num_envs
+
+        for i in np.flatnonzero(done):
+
+            # Calcul the score total over 100 episodes of all the environments
+            results.append(rewards[i])
+            if len(results) > 100:
+                results.pop(0)
+
+            score = np.sum(np.asarray(results)) / 100
+
+            if score >= -300:
+                print("Finished!!!")
+                save_agent(agent)
+                exit()
+
+            episode += 1
+
+            print("Episode", episode,
+                  "rewards", rewards[i],
+                  "score", score,
+                  "env steps/s", round(env_steps / (time.perf_counter() - start), 1))
+
+            rewards[i] = 0
+
+            # Save the state of the agent
+            if episode % 20 == 0:
+                save_agent(agent)
+
+def benchmark_agent(env):
+
+    BENCH_ACTIONS = 10000
+    BENCH_UPDATES = 100
+
+    inputs = env.observation_space.shape[0]
+    outputs_range = [env.action_space.low, env.action_space.high]
+
+    # Record the transitions of an untrained agent, shared by all the layouts
+    recorder = PPO(inputs, outputs_range)
+    states = []
+    s = env.reset()
+
+    for i in range(1000):
+
+        a, log_prob = recorder.action(s)
+        s2, r, done, _ = env.step(a)
+
+        states.append(s)
+        recorder.store(s, s2, r, a, done, log_prob)
+
+        s = env.reset() if done else s2
+
+    for fused in [None, 'split', 'shared']:
+
+        agent = PPO(inputs, outputs_range, fused)
+
+        # Warm up before timing
+        for i in range(100):
+            agent.action(states[i])
+
+        start = time.perf_counter()
+        for i in range(BENCH_ACTIONS):
+            agent.action(states[i % len(states)])
+        action_time = (time.perf_counter() - start) / BENCH_ACTIONS
+
+        start = time.perf_counter()
+        for i in range(BENCH_UPDATES):
+            agent.train()
+        update_time = (time.perf_counter() - start) / BENCH_UPDATES
+
+        print("Layout", fused or "separate",
+              "action latency", round(action_time * 1e6, 1), "us,",
+              "update time", round(update_time * 1e3, 3), "ms")
+
+def save_agent(agent):
+
+    if agent.fused:
+        torch.save(agent.model.state_dict(), FUSED_SAVE_FILE_PATH % agent.fused)
+    else:
+        torch.save((agent.critic.state_dict(), agent.actor.state_dict()), SAVE_FILE_PATH)
+
+def export_agent(env, agent):
+
+    CHECK_STATES = 100
+
+    # The mean and std towers run side by side in the same layers, the
+    # critic third of a split fused layer is dropped
+    if agent.fused:
+        model = agent.model
+        h1 = {name: value[:2 * ActorCritic.HIDDEN_LAYER_SIZE] for name, value in model.h1.named_parameters()}
+    else:
+        model = agent.actor
+        h1 = {name: torch.cat((getattr(model.h1_mean, name), getattr(model.h1_std, name)))
+            for name in ["weight", "bias"]}
+
+    # Each head reads its own half of the hidden layer unless it is shared
+    if agent.fused == 'shared':
+        pi_weight = torch.cat((model.pi_mean.weight, model.pi_std.weight))
+    else:
+        pi_weight = torch.block_diag(model.pi_mean.weight, model.pi_std.weight)
+
+    program = [
+        ("linear", h1),
+        ("relu", {}),
+        ("linear", {"weight": pi_weight, "bias": torch.cat((model.pi_mean.bias, model.pi_std.bias))}),
+        ("meanstd", {"scale": model.scale}),
+        ("gaussian", {"low": agent.outputs_range[0], "high": agent.outputs_range[1]})]
+
+    save_policy(EXPORT_FILE_PATH, env.spec.id, program)
+
+    # Check the NumPy forward against the torch one on visited states
+    policy = NumpyPolicy(EXPORT_FILE_PATH)
+    error = 0.0
+    s = env.reset()
+
+    for i in range(CHECK_STATES):
+
+        with torch.no_grad():
+            x = torch.as_tensor(np.float32(s))
+            mean, std = agent.model(x)[:2] if agent.fused else agent.actor(x)
+            expected = torch.cat((mean, std))
+
+        error = max(error, np.abs(policy.forward(s) - expected.cpu().numpy()).max())
+
+        s, _, done, _ = env.step(env.action_space.sample())
+
+        if done:
+            s = env.reset()
+
+    print("Policy exported to", EXPORT_FILE_PATH, "max error", error)
+
 def clean_agent():
-    os.remove(SAVE_FILE_PATH)
+
+    for path in [SAVE_FILE_PATH, FUSED_SAVE_FILE_PATH % 'shared', FUSED_SAVE_FILE_PATH % 'split', EXPORT_FILE_PATH]:
+        if os.path.exists(path):
+            os.remove(path)
 
 @click.command()
 @click.option('--play', flag_value='play', default=False)
 @click.option('--train', flag_value='train', default=True)
 @click.option('--clean', flag_value='clean', default=False)
-def run(play, train, clean):
+@click.option('--bench', flag_value='bench', default=False)
+@click.option('--export', flag_value='export', default=False)
+@click.option('--serve', type=int, default=0)
+@click.option('--fused', type=click.Choice(['shared', 'split']), default=None)
+@click.option('--compile', is_flag=True, default=False)
+@click.option('--publish', type=int, default=0)
+@click.option('--follow', is_flag=True, default=False)
+@click.option('--envs', type=int, default=0)
+@click.option('--asynchronous', is_flag=True, default=False)
+@click.option('--eval', 'evaluate', type=int, default=0)
+@click.option('--eval-async', type=int, default=0)
+@click.option('--record', type=str, default=None)
+@click.option('--record-every', type=int, default=1)
+@click.option('--episodes', type=int, default=0)
+def run(play, train, clean, bench, export, serve, fused, compile, publish, follow, envs, asynchronous, evaluate, eval_async, record, record_every, episodes):
 
     if clean:
         clean_agent()
@@ -262,26 +560,82 @@ def run(play, train, clean):
     # Start OpenAI environment
     env = gym.make('Pendulum-v0')
 
+    # Record the play mode to a video or to images instead of a window
+    if play and record:
+        env = FrameRecorder(env, record, record_every)
+
+    if bench:
+        benchmark_agent(env)
+        exit()
+
     # Create an agent
     agent = PPO(
-        env.observation_space.shape[0], [env.action_space.low, env.action_space.high])
+        env.observation_space.shape[0], [env.action_space.low, env.action_space.high], fused, compile)
 
-    try:
-        critic, actor = torch.load(SAVE_FILE_PATH)
-        agent.critic.load_state_dict(critic)
-        agent.actor.load_state_dict(actor)
+    loaded = False
 
+    try:
+        if fused:
+            agent.model.load_state_dict(torch.load(FUSED_SAVE_FILE_PATH % fused))
+        else:
+            critic, actor = torch.load(SAVE_FILE_PATH)
+            agent.critic.load_state_dict(critic)
+            agent.actor.load_state_dict(actor)
+        loaded = True
         print("Agent loaded!!!")
-    except:
+    except FileNotFoundError:
         print("Agent created!!!")
 
-    if play:
-        agent.critic.eval()
-        agent.actor.eval()
-        play_agent(env, agent)
-    elif train:
-        train_agent(env, agent)
+    # Exporting or compressing fresh weights would only produce a random policy
+    if not loaded and export:
+        raise click.ClickException("No agent saved in %s, train one first" % (FUSED_SAVE_FILE_PATH % fused if fused else SAVE_FILE_PATH))
+
+    # Share the weights of the policy every publish updates
+    if publish:
+        agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor, publish)
 
+    try:
+        if play:
+            if fused:
+                agent.model.eval()
+            else:
+                agent.critic.eval()
+                agent.actor.eval()
+            weights = WeightSubscriber(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor) if follow else None
+            try:
+                play_agent(env, agent, weights, episodes)
+            finally:
+                env.close()
+        elif export:
+            export_agent(env, agent)
+        elif evaluate:
+            evaluate_agent(env, agent.model if fused else agent.actor, mean_action, evaluate)
+        elif serve:
+            low, high = agent.outputs_range
+            serve_agent(env, agent.model if fused else agent.actor,
+                lambda pi: np.clip(np.random.normal(pi[0], pi[1]), low, high), serve)
+        elif train and envs:
+            train_vector_agent(vector_envs.make('Pendulum-v0', envs, asynchronous), agent)
+        elif train:
+
+            # Evaluate the published policies in a process of their own
+            evaluator = None
+            if eval_async:
+                if not agent.publisher:
+                    agent.publisher = WeightPublisher(SHARED_WEIGHTS_NAME, agent.model if fused else agent.actor, PUBLISH_INTERVAL)
+                evaluator = AsyncEvaluator(env, agent.model if fused else agent.actor, mean_action, eval_async, SHARED_WEIGHTS_NAME,
+                    "return", -np.inf)
+
+            try:
+                train_agent(env, agent, evaluator)
+            finally:
+                if evaluator:
+                    evaluator.close()
+    finally:
+
+        # Remove the region of the shared weights
+        if agent.publisher:
+            agent.publisher.close()
 
 if __name__ == '__main__':
     run()
@@ -0,0 +1,34 @@
+import gym
+
+# Repeats every action of the agent for a number of ticks of the simulator
+# and sums their rewards, the agent decides and stores a transition once per
+# repeat. The rewards of an episode add up to the same total as without the
+# wrapper, only the last observation of the repeat is seen by the agent.
+
+class ActionRepeat(gym.Wrapper):
+
+    def __init__(self, env, repeat, render=False):
+        super(ActionRepeat, self).__init__(env)
+
+        self.repeat = repeat
+
+        # The play mode renders the ticks in between the decisions, the one
+        # after the last tick is rendered by the play loop itself
+        self.render_ticks = render
+
+    def step(self, action):
+
+        rewards = 0.0
+
+        for i in range(self.repeat):
+
+            s, r, done, info = self.env.step(action)
+            rewards += r
+
+            if done:
+                break
+
+            if self.render_ticks and i < self.repeat - 1:
+                self.env.render()
+
+        return s, rewards, done, info
@@ -0,0 +1,59 @@
+import copy
+import os
+import time
+import torch
+import torch.nn as nn
+import torch.optim as optim
+
+# Compiles the learner step of an agent with torch.compile and runs its
+# forwards in bfloat16, shared by all the training scripts. The compiled graphs are kept in COMPILE_CACHE_DIR so the
+# launches after the first one skip most of the compilation.
+
+COMPILE_CACHE_DIR = "torch-compile-cache"
+
+def compile_learner(learn):
+
+    # Fall back to eager when torch.compile is not available
+    if not hasattr(torch, "compile"):
+        print("torch.compile is not available, the learner runs eagerly")
+        return learn
+
+    # The compiled graphs are cached on disk so only the first launch pays
+    # for the compilation. A compilation that fails raises, the learner
+    # never falls back to eager without saying so
+    os.environ.setdefault("TORCHINDUCTOR_CACHE_DIR", os.path.abspath(COMPILE_CACHE_DIR))
+    os.environ.setdefault("TORCHINDUCTOR_FX_GRAPH_CACHE", "1")
+
+    # The batch size never changes so the graphs are specialized on it
+    return torch.compile(learn, dynamic=False)
+
+def autocast(enabled):
+
+    # Only the forwards run in bfloat16, the weights, the gradients and the
+    # targets stay in float32
+    return torch.autocast("cpu", dtype=torch.bfloat16, enabled=enabled)
+
+def warmup_learner(agent, learn):
+
+    modules = [v for v in vars(agent).values() if isinstance(v, nn.Module)]
+    optimizers = [v for v in vars(agent).values() if isinstance(v, optim.Optimizer)]
+    weights = [copy.deepcopy(module.state_dict()) for module in modules]
+
+    start = time.perf_counter()
+
+    # The second call compiles the update with the optimizer state allocated
+    for i in range(2):
+        learn()
+
+    # Put the networks back and zero the optimizer state in place, which is
+    # the same as a fresh optimizer and keeps the compiled graphs valid
+    for module, state_dict in zip(modules, weights):
+        module.load_state_dict(state_dict)
+
+    for optimizer in optimizers:
+        for state in optimizer.state.values():
+            for value in state.values():
+                if torch.is_tensor(value):
+                    value.zero_()
+
+    print("Learner compiled in", round(time.perf_counter() - start, 1), "s")
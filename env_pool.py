@@ -0,0 +1,160 @@
+import gym
+import multiprocessing
+import numpy as np
+import signal
+import time
+from multiprocessing.shared_memory import SharedMemory
+
+# Runs environments with slow physics or rendering in worker processes. The
+# workers write their preprocessed frames straight into a ring of frames in
+# shared memory, only the commands, the rewards and the done flags go
+# through the pipes.
+#
+# The workers step together so the frames of a step fill one slot of the
+# ring, the parent reads the slot in place as an array with one row per
+# environment. A slot is rewritten RING_SIZE steps later, the frames that
+# must live longer have to be copied. The last slot of the ring holds the
+# terminal frames of the environments reset during the step.
+#
+# Like vector_envs, the pool follows the gym.vector interface with the
+# finished environments reset automatically.
+
+RING_SIZE = 4
+
+# Shared by the environments that have nothing to report
+EMPTY_INFO = {}
+
+def run_worker(id, index, preprocess, name, shape, dtype, wrapper, connection):
+
+    # The parent handles ctrl-c and closes the workers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    # The region belongs to the parent, whose resource tracker is shared
+    shm = SharedMemory(name=name)
+    frames = np.ndarray(shape, dtype=dtype, buffer=shm.buf)
+
+    env = gym.make(id)
+
+    if wrapper:
+        env = wrapper(env)
+
+    while 1:
+
+        command, slot, action = connection.recv()
+
+        if command == "reset":
+            frames[slot, index] = preprocess(env.reset())
+            connection.send(None)
+
+        elif command == "step":
+
+            s, r, done, _ = env.step(action)
+
+            if done:
+                frames[RING_SIZE, index] = preprocess(s)
+                s = env.reset()
+
+            frames[slot, index] = preprocess(s)
+            connection.send((r, done))
+
+        else:
+            break
+
+    env.close()
+
+    del frames
+    shm.close()
+
+class EnvPool:
+
+    def __init__(self, id, num_envs, frame_shape, preprocess, dtype=np.float32, wrapper=None):
+
+        self.num_envs = num_envs
+
+        # RING_SIZE slots of frames and the slot of the terminal frames
+        shape = (RING_SIZE + 1, num_envs) + tuple(frame_shape)
+        size = int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+        self.shm = SharedMemory(create=True, size=size)
+        self.frames = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf)
+
+        context = multiprocessing.get_context("spawn")
+
+        self.connections = []
+        self.processes = []
+
+        for i in range(num_envs):
+
+            connection, worker_connection = context.Pipe()
+
+            process = context.Process(target=run_worker, daemon=True,
+                args=(id, i, preprocess, self.shm.name, shape, dtype, wrapper, worker_connection))
+            process.start()
+
+            self.connections.append(connection)
+            self.processes.append(process)
+
+        self.slot = 0
+        self.steps = 0
+        self.start = None
+
+    def reset(self):
+
+        self.slot = 0
+
+        for connection in self.connections:
+            connection.send(("reset", self.slot, None))
+
+        for connection in self.connections:
+            connection.recv()
+
+        self.steps = 0
+        self.start = time.perf_counter()
+
+        return self.frames[self.slot]
+
+    def step_async(self, actions):
+
+        # The frames of the step go to the next slot, the ones of the last
+        # steps stay readable while the workers run
+        self.slot = (self.slot + 1) % RING_SIZE
+
+        for connection, action in zip(self.connections, actions):
+            connection.send(("step", self.slot, action))
+
+    def step_wait(self):
+
+        rewards = np.zeros(self.num_envs)
+        done = np.zeros(self.num_envs, dtype=bool)
+        infos = [EMPTY_INFO] * self.num_envs
+
+        for i, connection in enumerate(self.connections):
+
+            rewards[i], done[i] = connection.recv()
+
+            if done[i]:
+                infos[i] = {"terminal_observation": self.frames[RING_SIZE, i]}
+
+        self.steps += 1
+
+        return self.frames[self.slot], rewards, done, infos
+
+    def step(self, actions):
+
+        self.step_async(actions)
+        return self.step_wait()
+
+    def frames_per_second(self):
+        return self.steps * self.num_envs / (time.perf_counter() - self.start)
+
+    def close(self):
+
+        for connection in self.connections:
+            connection.send(("close", None, None))
+
+        for process in self.processes:
+            process.join()
+
+        del self.frames
+        self.shm.close()
+        self.shm.unlink()
@@ -0,0 +1,212 @@
+import copy
+import gym
+import json
+import multiprocessing
+import numpy as np
+import os
+import queue
+import signal
+import time
+import torch
+
+from shared_weights import WeightSubscriber
+
+# Evaluates a policy over many episodes without rendering, spread over a pool
+# of processes. Every episode is seeded with its own index so the results do
+# not depend on the number of processes, and the policy acts
+# deterministically: the most valued action for the discrete spaces, the
+# mean action for the continuous ones.
+#
+# The asynchronous evaluator runs beside the training in a process of its
+# own. It follows the weights published by the agent and evaluates every new
+# version it picks up, the versions published during an evaluation are
+# skipped for the newest one. The scores come back through a queue, the
+# learner spends no time on the evaluations.
+
+SEED = 0
+
+# Updates between the publications of the weights for the evaluator, when
+# the training does not publish them already
+PUBLISH_INTERVAL = 100
+
+# Seconds between two checks for new weights
+POLL_INTERVAL = 0.1
+
+# Seconds given to the evaluator to finish its evaluation when it is closed
+CLOSE_TIMEOUT = 5.0
+
+# Set in each process of the pool by init_worker
+worker = {}
+
+def greedy_action(output):
+
+    # Fused models give the policy before the value
+    if isinstance(output, tuple):
+        output = output[0]
+
+    return int(np.argmax(output))
+
+def mean_action(output):
+
+    # Gaussian policies give the mean before the standard deviation
+    if isinstance(output, tuple):
+        output = output[0]
+
+    return output
+
+def init_worker(id, policy, decide, preprocess, wrapper):
+
+    # One core per process, the pool gives the parallelism
+    torch.set_num_threads(1)
+
+    env = gym.make(id)
+
+    if wrapper:
+        env = wrapper(env)
+
+    worker.update(env=env, policy=policy.eval(), decide=decide, preprocess=preprocess)
+
+def run_episode(episode):
+
+    env = worker["env"]
+    policy = worker["policy"]
+    decide = worker["decide"]
+    preprocess = worker["preprocess"]
+
+    env.seed(SEED + episode)
+    s = env.reset()
+
+    rewards = 0
+    steps = 0
+
+    while 1:
+
+        x = torch.as_tensor(np.float32(preprocess(s) if preprocess else s)).unsqueeze(0)
+
+        with torch.inference_mode():
+            output = policy(x)
+
+        # Policies with several heads give one row per head
+        if isinstance(output, tuple):
+            output = tuple(o.numpy()[0] for o in output)
+        else:
+            output = output.numpy()[0]
+
+        s, r, done, _ = env.step(decide(output))
+
+        rewards += r
+        steps += 1
+
+        if done:
+            return rewards, steps
+
+def run_evaluator(id, policy, decide, episodes, name, preprocess, wrapper, results, stop):
+
+    # The trainer handles ctrl-c and stops the evaluator
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    init_worker(id, policy, decide, preprocess, wrapper)
+    weights = WeightSubscriber(name, worker["policy"])
+
+    while not stop.is_set():
+
+        if not weights.poll():
+            time.sleep(POLL_INTERVAL)
+            continue
+
+        version = weights.version
+        rewards, lengths = zip(*[run_episode(episode) for episode in range(episodes)])
+
+        results.put((version, {"return": statistics(rewards), "length": statistics(lengths)}))
+
+    weights.close()
+
+class AsyncEvaluator:
+
+    def __init__(self, env, policy, decide, episodes, name, metric="return", worst=-np.inf,
+                 preprocess=None, wrapper=None):
+
+        # The score is the mean of the metric over the episodes of the last
+        # evaluation, worst until the first one
+        self.metric = metric
+        self.score = worst
+        self.version = None
+
+        context = multiprocessing.get_context("spawn")
+
+        self.results = context.Queue()
+        self.stop = context.Event()
+
+        self.process = context.Process(target=run_evaluator, daemon=True,
+            args=(env.spec.id, copy.deepcopy(policy).cpu(), decide, episodes, name, preprocess, wrapper,
+                  self.results, self.stop))
+        self.process.start()
+
+    def poll(self):
+
+        # Take the evaluations finished since the last call, give the score
+        while 1:
+
+            try:
+                self.version, stats = self.results.get_nowait()
+            except queue.Empty:
+                return self.score
+
+            self.score = stats[self.metric]["mean"]
+
+            print("Evaluation of version", self.version,
+                  self.metric, round(self.score, 2),
+                  "std", round(stats[self.metric]["std"], 2),
+                  "min", round(stats[self.metric]["min"], 2),
+                  "max", round(stats[self.metric]["max"], 2))
+
+    def close(self):
+
+        # An evaluation in progress is not waited for past the timeout
+        self.stop.set()
+        self.process.join(CLOSE_TIMEOUT)
+
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join()
+
+def statistics(values):
+
+    values = np.asarray(values, dtype=np.float64)
+
+    stats = {"mean": values.mean(), "std": values.std(), "min": values.min(), "max": values.max()}
+
+    for p in [5, 25, 50, 75, 95]:
+        stats["p%d" % p] = np.percentile(values, p)
+
+    return {key: float(value) for key, value in stats.items()}
+
+def evaluate_agent(env, policy, decide, episodes, processes=None, preprocess=None, wrapper=None):
+
+    processes = min(processes or os.cpu_count(), episodes)
+
+    # The processes get their own copy of the policy on CPU
+    policy = copy.deepcopy(policy).cpu()
+
+    start = time.perf_counter()
+
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(processes, init_worker, (env.spec.id, policy, decide, preprocess, wrapper)) as pool:
+        results = pool.map(run_episode, range(episodes))
+
+    elapsed = time.perf_counter() - start
+
+    rewards, lengths = zip(*results)
+
+    stats = {
+        "env": env.spec.id,
+        "episodes": episodes,
+        "processes": processes,
+        "return": statistics(rewards),
+        "length": statistics(lengths),
+        "seconds": round(elapsed, 3),
+        "episodes/s": round(episodes / elapsed, 1)}
+
+    print(json.dumps(stats))
+
+    return stats
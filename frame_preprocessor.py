@@ -0,0 +1,101 @@
+import click
+import numpy as np
+import threading
+import time
+
+# Turns the RGB frames of the environments into the inputs of the networks:
+# greyscale, crop of the rows at the bottom of the frame, downsampling and
+# conversion to uint8. It takes a single frame or a batch of frames with one
+# row per environment.
+#
+# The pixels that are kept are copied once into a float32 buffer and
+# converted by a single matmul with the coefficients. The float32 buffers
+# are allocated at the first call for a shape of frames, by thread. Every
+# call returns a new output array, which the caller can keep.
+
+# The coefficients the agents were trained with, they sum a bit above 1 so
+# the white pixels saturate in uint8
+GREYSCALE = (0.299, 0.587, 0.144)
+
+class FramePreprocessor:
+
+    def __init__(self, crop_bottom=0, downsample=1, coefficients=GREYSCALE, dtype=np.uint8):
+
+        self.crop_bottom = crop_bottom
+        self.downsample = downsample
+        self.coefficients = np.asarray(coefficients, dtype=np.float32)
+        self.dtype = np.dtype(dtype)
+
+        # Buffers by thread and shape of the frames
+        self.buffers = {}
+
+    def shape(self, frame_shape):
+
+        # Shape of the output for a frame of the environment
+        height, width = frame_shape[0] - self.crop_bottom, frame_shape[1]
+        return (-(-height // self.downsample), -(-width // self.downsample))
+
+    def __call__(self, frames):
+
+        frames = np.asarray(frames)
+
+        # Crop and downsample first, only the pixels kept are converted
+        pixels = frames[..., :frames.shape[-3] - self.crop_bottom:self.downsample, ::self.downsample, :3]
+
+        key = (threading.get_ident(), frames.shape)
+
+        if key not in self.buffers:
+            self.buffers[key] = (
+                np.empty(pixels.shape, dtype=np.float32),
+                np.empty(pixels.shape[:-1], dtype=np.float32))
+
+        channels, grey = self.buffers[key]
+
+        np.copyto(channels, pixels)
+        np.matmul(channels, self.coefficients, out=grey)
+
+        if self.dtype.kind in "ui":
+
+            # Round to the nearest integer and saturate
+            grey += 0.5
+            np.clip(grey, 0, np.iinfo(self.dtype).max, out=grey)
+
+        return grey.astype(self.dtype)
+
+def benchmark_preprocessor(frame_shape, num_envs, crop_bottom, downsample, steps=200):
+
+    frames = np.random.randint(0, 256, (num_envs,) + tuple(frame_shape), dtype=np.uint8)
+    preprocess = FramePreprocessor(crop_bottom, downsample)
+
+    # The conversion done so far by the training scripts, frame by frame
+    def reference():
+        for frame in frames:
+            np.dot(frame[...,:3], GREYSCALE)
+
+    for name, convert in [("np.dot float64", reference), ("preprocessor", lambda: preprocess(frames))]:
+
+        # Warm up before timing
+        convert()
+
+        start = time.perf_counter()
+        for i in range(steps):
+            convert()
+        elapsed = time.perf_counter() - start
+
+        print(name, "per frame", round(elapsed / (steps * num_envs) * 1e6, 1), "us")
+
+    print("Output", preprocess.shape(frame_shape), preprocess.dtype,
+          "bytes per frame", np.prod(preprocess.shape(frame_shape)) * preprocess.dtype.itemsize,
+          "instead of", np.prod(frame_shape[:2]) * 8)
+
+@click.command()
+@click.option('--envs', type=int, default=16)
+@click.option('--crop', type=int, default=0)
+@click.option('--downsample', type=int, default=1)
+def run(envs, crop, downsample):
+
+    # Frames of the size of CarRacing
+    benchmark_preprocessor((96, 96, 3), envs, crop, downsample)
+
+if __name__ == '__main__':
+    run()
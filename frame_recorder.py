@@ -0,0 +1,130 @@
+import gym
+import itertools
+import os
+import queue
+import threading
+
+# Records the play mode instead of showing it. The calls to render() of the
+# play loop ask the environment for an rgb_array frame, and a background
+# thread encodes the frames while the loop keeps stepping.
+#
+# A path with an extension is written as a video (or gif), any other path
+# is a directory that receives one png per frame. Only one tick out of
+# every `every` is rendered at all. The frames go through a bounded queue,
+# when the encoder falls behind the new frames are dropped rather than
+# blocking the loop, with a warning at the first one, and close() reports
+# how many. When the encoder fails, its error is raised by the next step()
+# or by close().
+#
+# The wrapper goes right around the environment, under ActionRepeat, so the
+# ticks rendered by the repeat are recorded too.
+
+QUEUE_SIZE = 128
+
+def write_frames(path, fps, frames):
+
+    # Only the recording needs imageio, and the ffmpeg plugin for the videos
+    import imageio
+
+    if os.path.splitext(path)[1]:
+        writer = imageio.get_writer(path, fps=fps)
+        write = writer.append_data
+    else:
+        os.makedirs(path, exist_ok=True)
+        writer = None
+        index = itertools.count()
+        write = lambda frame: imageio.imwrite(os.path.join(path, "frame_%06d.png" % next(index)), frame)
+
+    while 1:
+
+        frame = frames.get()
+
+        if frame is None:
+            break
+
+        write(frame)
+
+    if writer:
+        writer.close()
+
+class FrameRecorder(gym.Wrapper):
+
+    def __init__(self, env, path, every=1, fps=None):
+        super(FrameRecorder, self).__init__(env)
+
+        self.path = path
+        self.every = every
+        self.ticks = 0
+        self.recorded = 0
+        self.dropped = 0
+
+        # The frame rate of the simulator, slowed down by the decimation
+        if fps is None:
+            fps = env.metadata.get("video.frames_per_second", 30)
+
+        # Set by the encoder when it fails, raised in the play loop
+        self.error = None
+
+        self.frames = queue.Queue(QUEUE_SIZE)
+        self.encoder = threading.Thread(target=self.encode, args=(max(fps / every, 1),), daemon=True)
+        self.encoder.start()
+
+    def encode(self, fps):
+
+        try:
+            write_frames(self.path, fps, self.frames)
+        except Exception as error:
+            self.error = error
+
+    def check(self):
+
+        # Raised once, by the next step() or by close()
+        error, self.error = self.error, None
+
+        if error:
+            raise RuntimeError("Recording to %s failed" % self.path) from error
+
+    def step(self, action):
+
+        self.check()
+        return self.env.step(action)
+
+    def render(self, mode="rgb_array", **kwargs):
+
+        self.ticks += 1
+
+        if (self.ticks - 1) % self.every:
+            return None
+
+        frame = self.env.render(mode="rgb_array", **kwargs)
+
+        try:
+            self.frames.put_nowait(frame)
+            self.recorded += 1
+        except queue.Full:
+
+            # Warn once, the total is reported by close()
+            if not self.dropped:
+                print("The encoder is behind, frames of", self.path, "are dropped")
+
+            self.dropped += 1
+
+        return frame
+
+    def close(self):
+
+        # Wait for the encoder to write the frames left in the queue, unless
+        # it stopped on an error and will not take the end marker
+        while self.encoder.is_alive():
+            try:
+                self.frames.put(None, timeout=0.1)
+                self.encoder.join()
+            except queue.Full:
+                pass
+
+        print("Recorded", self.recorded, "frames to", self.path,
+              "dropped", self.dropped)
+
+        super(FrameRecorder, self).close()
+
+        self.check()
@@ -0,0 +1,161 @@
+import collections
+import copy
+import threading
+import torch
+
+# Runs the updates of an agent in a thread of their own while the training
+# loop keeps stepping the environment, torch releases the GIL in its
+# kernels so the two overlap.
+#
+# The transitions of the actor go through a queue, only the learner thread
+# touches the replay memory. The actor acts with a snapshot of the policy
+# held in one of two buffers: after each update the learner copies the
+# weights into the other buffer and swaps them. The buffer in use by the
+# actor is never written, the learner skips the copy when the actor still
+# holds the buffer it would write.
+#
+# Only the calls of agent.train() that update the networks are counted as
+# updates, the agent returns False while its memory is too small to sample
+# a batch. An exception in the learner thread is raised again in the
+# training loop by the next act() or store().
+
+class PolicySnapshot:
+
+    def __init__(self, policy):
+
+        self.buffers = [copy.deepcopy(policy), copy.deepcopy(policy)]
+        self.versions = [0, 0]
+
+        self.front = 0
+        self.reading = None
+        self.lock = threading.Lock()
+
+    def acquire(self):
+
+        with self.lock:
+            self.reading = self.front
+
+        return self.buffers[self.reading], self.versions[self.reading]
+
+    def release(self):
+        self.reading = None
+
+    def publish(self, policy, version):
+
+        with self.lock:
+            back = 1 - self.front
+
+            if self.reading == back:
+                return False
+
+        with torch.no_grad():
+            for target, source in zip(self.buffers[back].state_dict().values(), policy.state_dict().values()):
+                target.copy_(source)
+
+        self.versions[back] = version
+
+        with self.lock:
+            self.front = back
+
+        return True
+
+class LearnerThread:
+
+    def __init__(self, agent, policy, update_ratio=1.0):
+
+        self.agent = agent
+        self.policy = policy
+        self.update_ratio = update_ratio
+
+        self.snapshot = PolicySnapshot(policy)
+        self.transitions = collections.deque()
+
+        self.steps = 0
+        self.updates = 0
+        self.error = None
+        self.condition = threading.Condition()
+
+        # Held during each update, the agent can be saved under it
+        self.lock = threading.Lock()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def check(self):
+
+        if self.error:
+            raise RuntimeError("The learner thread failed") from self.error
+
+    def act(self, action):
+
+        self.check()
+
+        # Act with the newest snapshot, also give how many updates it is
+        # behind the learner
+        policy, version = self.snapshot.acquire()
+
+        try:
+            a = action(policy)
+        finally:
+            self.snapshot.release()
+
+        return a, self.updates - version
+
+    def store(self, *args):
+
+        self.check()
+
+        self.transitions.append(args)
+
+        with self.condition:
+            self.steps += 1
+            self.condition.notify()
+
+    def run(self):
+
+        try:
+            self.learn()
+        except Exception as error:
+            self.error = error
+
+    def learn(self):
+
+        # Steps of the environment when the agent last had nothing to learn
+        idle = -1
+
+        while 1:
+
+            # Never more than update_ratio updates per step of the
+            # environment, and no new call of train() that did not update
+            # before a new step
+            with self.condition:
+                while self.running and (self.updates >= self.update_ratio * self.steps or self.steps == idle):
+                    self.condition.wait()
+
+                if not self.running:
+                    return
+
+                steps = self.steps
+
+            with self.lock:
+
+                while self.transitions:
+                    self.agent.store(*self.transitions.popleft())
+
+                updated = self.agent.train()
+
+            if not updated:
+                idle = steps
+                continue
+
+            self.updates += 1
+            self.snapshot.publish(self.policy, self.updates)
+
+    def close(self):
+
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+
+        self.thread.join()
@@ -0,0 +1,47 @@
+import numpy as np
+
+# Serves the exploration noise of the continuous-control agents. Standard
+# normals are drawn by blocks of BLOCK_SIZE rows with NumPy and handed out
+# one row per action, scaled by the current noise level, instead of
+# sampling a distribution at every step.
+
+class NoisePool:
+
+    BLOCK_SIZE = 10000
+
+    def __init__(self, outputs):
+
+        self.outputs = outputs
+        self.fill()
+
+    def fill(self):
+
+        # Draw a whole block of standard normals at once
+        self.block = np.random.standard_normal((self.BLOCK_SIZE, self.outputs)).astype(np.float32)
+        self.index = 0
+
+    def sample(self, scale):
+
+        if self.index == self.BLOCK_SIZE:
+            self.fill()
+
+        noise = self.block[self.index]
+        self.index += 1
+
+        return noise * scale
+
+    def samples(self, n, scale):
+
+        # A batch larger than a block does not go through the pool, its rows
+        # are drawn at once on their own and the block is left as it is
+        if n > self.BLOCK_SIZE:
+            return np.random.standard_normal((n, self.outputs)).astype(np.float32) * scale
+
+        # A batch of rows, the ones left at the end of a block are skipped
+        if self.index + n > self.BLOCK_SIZE:
+            self.fill()
+
+        noise = self.block[self.index:self.index + n]
+        self.index += n
+
+        return noise * scale
@@ -0,0 +1,180 @@
+import click
+import gym
+import numpy as np
+import time
+
+from frame_preprocessor import FramePreprocessor
+
+# Runs the policies exported by the training scripts with NumPy only, the
+# play mode then needs neither torch nor the optimizers and target networks.
+#
+# An exported policy is a flat .npz holding the id of the environment, the
+# list of ops and the parameters of each op named "<index>.<name>". The ops
+# run one after the other on the observation and the last one turns the
+# output of the network into the action.
+
+def save_policy(path, env, program):
+
+    params = {}
+
+    for i, (op, op_params) in enumerate(program):
+        for name, value in op_params.items():
+
+            # Accept torch tensors without importing torch
+            if hasattr(value, "detach"):
+                value = value.detach().cpu().numpy()
+
+            params["%d.%s" % (i, name)] = np.asarray(value, dtype=np.float32)
+
+    np.savez(path, env=env, ops=np.array([op for op, _ in program]), **params)
+
+class NumpyPolicy:
+
+    def __init__(self, path):
+
+        data = np.load(path)
+
+        self.env = str(data["env"])
+        self.program = []
+
+        for i, op in enumerate(data["ops"]):
+
+            prefix = "%d." % i
+            params = {key[len(prefix):]: data[key] for key in data.files if key.startswith(prefix)}
+
+            # The preprocessor is built once, its buffers are reused by the
+            # following calls
+            if op == "frames":
+                params = {"preprocess": FramePreprocessor(
+                    int(params["crop_bottom"]), int(params["downsample"]), params["coefficients"])}
+
+            self.program.append((getattr(self, str(op)), params))
+
+    def forward(self, x):
+
+        x = np.asarray(x, dtype=np.float32)
+
+        for op, params in self.program[:-1]:
+            x = op(x, **params)
+
+        return x
+
+    def action(self, s):
+
+        op, params = self.program[-1]
+        return op(self.forward(s), **params)
+
+    # Layers
+
+    def frames(self, x, preprocess):
+        return preprocess(x)
+
+    def flatten(self, x):
+        return x.reshape(-1)
+
+    # The layers take one state or a batch with one state per row
+
+    def linear(self, x, weight, bias):
+        return x @ weight.T + bias
+
+    def layernorm(self, x, weight, bias, eps):
+
+        mean = x.mean(axis=-1, keepdims=True)
+        var = x.var(axis=-1, keepdims=True)
+
+        return (x - mean) / np.sqrt(var + eps) * weight + bias
+
+    def relu(self, x):
+        return np.maximum(x, 0.0)
+
+    def tanh(self, x):
+        return np.tanh(x)
+
+    def softmax(self, x):
+
+        e = np.exp(x - x.max(axis=-1, keepdims=True))
+        return e / e.sum(axis=-1, keepdims=True)
+
+    def meanstd(self, x, scale):
+
+        # The first half are the means, the second half the deviations
+        n = x.shape[-1] // 2
+        return np.concatenate((np.tanh(x[..., :n]) * scale, np.logaddexp(0.0, x[..., n:])), axis=-1)
+
+    # Actions
+
+    def argmax(self, x):
+        return int(np.argmax(x))
+
+    def sample(self, x):
+
+        # Invert the cumulative distribution with a single uniform draw
+        u = np.random.random()
+
+        for a in range(len(x) - 1):
+            u -= x[a]
+            if u < 0:
+                return a
+
+        return len(x) - 1
+
+    def gaussian(self, x, low, high):
+
+        n = len(x) // 2
+        a = x[:n] + x[n:] * np.random.standard_normal(n)
+
+        return np.clip(a, low, high)
+
+    def clip(self, x, low, high):
+        return np.clip(x, low, high)
+
+def play_agent(env, policy):
+
+    episode = 0
+
+    while 1:
+
+        rewards = 0
+        steps = 0
+        elapsed = 0
+        s = env.reset()
+
+        while 1:
+
+            env.render()
+
+            start = time.perf_counter()
+            a = policy.action(s)
+            elapsed += time.perf_counter() - start
+
+            s, r, done, _ = env.step(a)
+
+            rewards += r
+            steps += 1
+
+            if done:
+
+                episode += 1
+
+                print("Episode", episode,
+                      "finished after", steps,
+                      "rewards", rewards,
+                      "action latency", round(elapsed / steps * 1e6, 1), "us")
+
+                break
+
+@click.command()
+@click.argument('path')
+def run(path):
+
+    start = time.perf_counter()
+
+    policy = NumpyPolicy(path)
+    env = gym.make(policy.env)
+
+    print("Policy loaded in", round(time.perf_counter() - start, 3), "s")
+
+    play_agent(env, policy)
+
+if __name__ == '__main__':
+    run()
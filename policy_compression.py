@@ -0,0 +1,182 @@
+import copy
+import numpy as np
+import time
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+import torch.optim as optim
+
+# Makes cheaper versions of the trained policies of the continuous-control
+# agents for play and inference, and measures what they cost in score.
+#
+# quantize_agent stores the weights of the policy in int8 and keeps them
+# only when the actions stay close to the float32 ones. distill_agent trains
+# a small student to give the actions of the policy (the teacher) on the
+# states they visit. The optional preprocess turns the observations of the
+# environment into the inputs of the networks.
+
+def quantize_policy(pi):
+
+    # The weights of the Linear layers are stored in int8 and their inputs
+    # are quantized on the fly, the quantized kernels only run on CPU
+    return torch.quantization.quantize_dynamic(
+        copy.deepcopy(pi).cpu(), {nn.Linear}, dtype=torch.qint8, inplace=True)
+
+def quantize_agent(env, agent, path, preprocess=None):
+
+    QUANTIZE_STATES = 1000
+    QUANTIZE_TOLERANCE = 0.05
+    BENCH_ACTIONS = 1000
+
+    # Record the states visited by the policy
+    states = []
+    s = env.reset()
+
+    if preprocess:
+        s = preprocess(s)
+
+    for i in range(QUANTIZE_STATES):
+
+        states.append(s)
+        s, _, done, _ = env.step(agent.action(s))
+
+        if done:
+            s = env.reset()
+
+        if preprocess:
+            s = preprocess(s)
+
+    states = torch.as_tensor(np.float32(states))
+
+    pi = copy.deepcopy(agent.pi).cpu()
+    pi_int8 = quantize_policy(agent.pi)
+
+    with torch.inference_mode():
+
+        error = (pi_int8(states) - pi(states)).abs().max().item()
+
+        for name, model in [("float32", pi), ("int8", pi_int8)]:
+
+            # Warm up before timing
+            for i in range(100):
+                model(states[i:i+1])
+
+            start = time.perf_counter()
+            for i in range(BENCH_ACTIONS):
+                model(states[i:i+1])
+            latency = (time.perf_counter() - start) / BENCH_ACTIONS
+
+            start = time.perf_counter()
+            model(states)
+            throughput = len(states) / (time.perf_counter() - start)
+
+            print("Policy", name,
+                  "action latency", round(latency * 1e6, 1), "us,",
+                  "throughput", round(throughput), "states/s")
+
+    if error > QUANTIZE_TOLERANCE:
+        print("Max action error", error, "above", QUANTIZE_TOLERANCE, "the policy is not saved")
+        return
+
+    torch.save(pi_int8.state_dict(), path)
+    print("Policy quantized to", path, "max action error", error)
+
+def policy_action(policy, s):
+
+    device = next(policy.parameters()).device
+
+    with torch.inference_mode():
+        return policy(torch.as_tensor(np.float32(s), device=device).unsqueeze(0)).cpu().numpy()[0]
+
+def evaluate_policy(env, policy, episodes, preprocess=None):
+
+    results = []
+    elapsed = 0
+    steps = 0
+
+    for episode in range(episodes):
+
+        rewards = 0
+        s = env.reset()
+
+        if preprocess:
+            s = preprocess(s)
+
+        while 1:
+
+            start = time.perf_counter()
+            a = policy_action(policy, s)
+            elapsed += time.perf_counter() - start
+
+            s, r, done, _ = env.step(a)
+
+            if preprocess:
+                s = preprocess(s)
+
+            rewards += r
+            steps += 1
+
+            if done:
+                results.append(rewards)
+                break
+
+    return np.mean(results), elapsed / steps
+
+def distill_agent(env, teacher, student, path, steps=10000, preprocess=None):
+
+    DISTILL_ROUNDS = 4
+    DISTILL_EPOCHS = 10
+    DISTILL_BATCH_SIZE = 256
+    EVAL_EPISODES = 5
+
+    device = next(student.parameters()).device
+    optimizer = optim.Adam(student.parameters(), lr=1e-3)
+
+    states = []
+
+    # The first round visits the states of the teacher and the next ones the
+    # states of the student, the actions are always those of the teacher
+    for k in range(DISTILL_ROUNDS):
+
+        policy = teacher if k == 0 else student
+        s = env.reset()
+
+        if preprocess:
+            s = preprocess(s)
+
+        for i in range(steps):
+
+            states.append(s)
+            s, _, done, _ = env.step(policy_action(policy, s))
+
+            if done:
+                s = env.reset()
+
+            if preprocess:
+                s = preprocess(s)
+
+        x = torch.as_tensor(np.float32(states), device=device)
+
+        with torch.no_grad():
+            y = teacher(x)
+
+        for epoch in range(DISTILL_EPOCHS):
+            for batch in torch.randperm(len(x), device=device).split(DISTILL_BATCH_SIZE):
+
+                loss = F.mse_loss(student(x[batch]), y[batch])
+
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+
+        print("Round", k + 1, "states", len(states), "loss", loss.item())
+
+    torch.save(student.state_dict(), path)
+
+    teacher_score, teacher_latency = evaluate_policy(env, teacher, EVAL_EPISODES, preprocess)
+    student_score, student_latency = evaluate_policy(env, student, EVAL_EPISODES, preprocess)
+
+    print("Teacher score", teacher_score, "action latency", round(teacher_latency * 1e6, 1), "us")
+    print("Student score", student_score, "action latency", round(student_latency * 1e6, 1), "us")
+    print("Student speedup", round(teacher_latency / student_latency, 1),
+          "score gap", teacher_score - student_score)
@@ -0,0 +1,157 @@
+import collections
+import gym
+import numpy as np
+import queue
+import threading
+import time
+import torch
+
+# Serves the policy of an agent to many environments at once. Each client
+# asks for one state and blocks, the server thread gathers the requests that
+# arrive within the latency budget, runs them through the policy as a single
+# batch and hands every client its own row of the output.
+
+class Request:
+
+    __slots__ = ('state', 'output', 'done', 'start')
+
+    def __init__(self, state):
+
+        self.state = state
+        self.output = None
+        self.done = threading.Event()
+        self.start = time.perf_counter()
+
+class PolicyServer:
+
+    MAX_BATCH_SIZE = 64
+    LATENCY_BUDGET = 1e-3
+
+    def __init__(self, policy, max_batch_size=MAX_BATCH_SIZE, latency_budget=LATENCY_BUDGET):
+
+        self.policy = policy
+
+        # Quantized policies have no parameters and run on CPU
+        parameters = list(policy.parameters())
+        self.device = parameters[0].device if parameters else torch.device("cpu")
+
+        self.max_batch_size = max_batch_size
+        self.latency_budget = latency_budget
+
+        self.requests = queue.Queue()
+        self.latencies = []
+        self.batch_sizes = collections.Counter()
+
+        self.running = True
+        self.thread = threading.Thread(target=self.serve, daemon=True)
+        self.thread.start()
+
+    def action(self, s):
+
+        request = Request(np.asarray(s, dtype=np.float32))
+
+        self.requests.put(request)
+        request.done.wait()
+
+        self.latencies.append(time.perf_counter() - request.start)
+
+        return request.output
+
+    def serve(self):
+
+        while self.running:
+
+            try:
+                batch = [self.requests.get(timeout=0.1)]
+            except queue.Empty:
+                continue
+
+            # Gather the requests arriving within the budget of the first one
+            deadline = batch[0].start + self.latency_budget
+
+            while len(batch) < self.max_batch_size:
+
+                timeout = deadline - time.perf_counter()
+
+                try:
+                    if timeout > 0:
+                        batch.append(self.requests.get(timeout=timeout))
+                    else:
+                        batch.append(self.requests.get_nowait())
+                except queue.Empty:
+                    break
+
+            self.batch_sizes[len(batch)] += 1
+
+            states = torch.as_tensor(np.stack([request.state for request in batch]), device=self.device)
+
+            with torch.inference_mode():
+                outputs = self.policy(states)
+
+            # Policies with several heads give one tuple per request
+            if isinstance(outputs, tuple):
+                rows = zip(*[output.cpu().numpy() for output in outputs])
+            else:
+                rows = outputs.cpu().numpy()
+
+            for request, row in zip(batch, rows):
+                request.output = row
+                request.done.set()
+
+    def close(self):
+
+        self.running = False
+        self.thread.join()
+
+    def report(self):
+
+        latencies = np.asarray(self.latencies) * 1e6
+
+        print("Requests", len(latencies),
+              "latency p50", round(np.percentile(latencies, 50), 1), "us,",
+              "p99", round(np.percentile(latencies, 99), 1), "us")
+
+        # Batch sizes by powers of two
+        histogram = collections.Counter()
+        for size, count in self.batch_sizes.items():
+            histogram[2 ** (size.bit_length() - 1)] += count
+
+        print("Batch sizes")
+        for low in sorted(histogram):
+            print("  %3d-%-3d %d" % (low, min(2 * low - 1, self.max_batch_size), histogram[low]))
+
+def serve_agent(env, policy, decide, clients, steps=1000, preprocess=lambda s: s):
+
+    # A batch holding every client is complete, no need to wait any longer
+    server = PolicyServer(policy, min(clients, PolicyServer.MAX_BATCH_SIZE))
+
+    # Every client steps its own environment with the actions of the server
+    def client():
+
+        client_env = gym.make(env.spec.id)
+        s = preprocess(client_env.reset())
+
+        for i in range(steps):
+
+            s, _, done, _ = client_env.step(decide(server.action(s)))
+            s = preprocess(s)
+
+            if done:
+                s = preprocess(client_env.reset())
+
+    threads = [threading.Thread(target=client) for i in range(clients)]
+
+    start = time.perf_counter()
+
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    elapsed = time.perf_counter() - start
+
+    server.close()
+
+    print("Clients", clients, "env steps/s", round(clients * steps / elapsed, 1))
+    server.report()
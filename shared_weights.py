@@ -0,0 +1,229 @@
+import click
+import multiprocessing
+import numpy as np
+import time
+import torch
+import torch.nn as nn
+from multiprocessing import resource_tracker
+from multiprocessing.shared_memory import SharedMemory
+
+# Shares the weights of a module between a training process and any number
+# of play or evaluation processes without going through the disk.
+#
+# The shared memory region holds a header with a sequence number and the
+# number of values, followed by all the tensors of the module flattened in
+# float32. The writer makes the sequence odd while it copies the weights and
+# even again once they are complete, a reader keeps a copy only when the
+# sequence was the same even number before and after it (seqlock). The
+# version of the weights is half the sequence number.
+#
+# Both ends go through a private flat vector. The writer packs the module
+# into it before taking the sequence, so the odd window is a single copy,
+# and a reader unpacks it into the module only once the copy is known to be
+# complete, so the module never holds a torn set of weights.
+
+HEADER_SIZE = 16
+
+def flat_views(module, data):
+
+    views = []
+    offset = 0
+
+    for tensor in module.state_dict().values():
+        views.append((tensor, data[offset:offset + tensor.numel()].view(tensor.shape)))
+        offset += tensor.numel()
+
+    return views
+
+def module_size(module):
+    return sum(tensor.numel() for tensor in module.state_dict().values())
+
+class WeightPublisher:
+
+    def __init__(self, name, module, interval=1):
+
+        size = module_size(module)
+
+        # Replace the region left over by a previous run
+        try:
+            SharedMemory(name=name).unlink()
+        except FileNotFoundError:
+            pass
+
+        self.shm = SharedMemory(name=name, create=True, size=HEADER_SIZE + 4 * size)
+
+        self.header = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+        self.header[:] = [0, size]
+
+        self.data = torch.frombuffer(self.shm.buf, dtype=torch.float32, offset=HEADER_SIZE, count=size)
+
+        self.staging = torch.zeros(size)
+        self.views = flat_views(module, self.staging)
+
+        self.interval = interval
+        self.updates = 0
+
+        self.publish()
+
+    @property
+    def version(self):
+        return int(self.header[0]) // 2
+
+    def update(self):
+
+        # Called after every update of the module
+        self.updates += 1
+
+        if self.updates % self.interval == 0:
+            self.publish()
+
+    def publish(self):
+
+        with torch.no_grad():
+            for tensor, view in self.views:
+                view.copy_(tensor)
+
+        self.header[0] += 1
+        self.data.copy_(self.staging)
+        self.header[0] += 1
+
+    def close(self):
+
+        del self.views, self.data, self.header
+        self.shm.close()
+        self.shm.unlink()
+
+class WeightSubscriber:
+
+    def __init__(self, name, module):
+
+        # The region belongs to the publisher, it must not be removed when
+        # this process exits. The children of a process share its tracker
+        # and must leave the registration of the publisher in place
+        self.shm = SharedMemory(name=name)
+
+        if multiprocessing.parent_process() is None:
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+        self.header = np.ndarray(2, dtype=np.int64, buffer=self.shm.buf)
+
+        size = module_size(module)
+
+        if self.header[1] != size:
+            raise ValueError("%s holds %d values, the module has %d" % (name, self.header[1], size))
+
+        self.data = torch.frombuffer(self.shm.buf, dtype=torch.float32, offset=HEADER_SIZE, count=size)
+
+        self.staging = torch.zeros(size)
+        self.views = flat_views(module, self.staging)
+
+        self.sequence = 0
+
+    @property
+    def version(self):
+        return self.sequence // 2
+
+    @property
+    def latest(self):
+
+        # The version being published, without copying anything
+        return int(self.header[0]) // 2
+
+    def poll(self):
+
+        # Load the newest complete weights, return whether they changed
+        while 1:
+
+            sequence = int(self.header[0])
+
+            if sequence == self.sequence:
+                return False
+
+            if sequence % 2 == 1:
+                continue
+
+            self.staging.copy_(self.data)
+
+            # Keep the copy only if no publish started in the meantime
+            if int(self.header[0]) == sequence:
+                break
+
+        with torch.no_grad():
+            for tensor, view in self.views:
+                tensor.copy_(view)
+
+        self.sequence = sequence
+        return True
+
+    def close(self):
+
+        del self.views, self.data, self.header
+        self.shm.close()
+
+def run_reader(name, size, stop, results):
+
+    module = nn.Linear(size, 1, bias=False)
+    weights = WeightSubscriber(name, module)
+
+    polls = 0
+    torn = 0
+
+    # Every version fills all the weights with its number, a copy mixing two
+    # versions is torn
+    while not stop.is_set() or weights.latest != weights.version:
+
+        if weights.poll():
+            polls += 1
+            torn += bool(module.weight.min() != module.weight.max())
+
+    # The cost of a poll that finds nothing new
+    POLLS = 100000
+
+    start = time.perf_counter()
+    for i in range(POLLS):
+        weights.poll()
+    poll_time = (time.perf_counter() - start) / POLLS
+
+    results.put((polls, torn, weights.version, poll_time))
+    weights.close()
+
+def stress_test(size, versions, name="shared-weights-stress"):
+
+    module = nn.Linear(size, 1, bias=False)
+    publisher = WeightPublisher(name, module)
+
+    context = multiprocessing.get_context("spawn")
+    stop = context.Event()
+    results = context.Queue()
+
+    reader = context.Process(target=run_reader, args=(name, size, stop, results))
+    reader.start()
+
+    start = time.perf_counter()
+
+    with torch.no_grad():
+        for version in range(versions):
+            module.weight.fill_(version)
+            publisher.publish()
+
+    publish_time = (time.perf_counter() - start) / versions
+
+    stop.set()
+    polls, torn, last, poll_time = results.get()
+    reader.join()
+
+    print(versions, "versions of", size, "values,",
+          "publish", round(publish_time * 1e6, 1), "us,",
+          "reads", polls, "torn", torn, "last version", last, "of", publisher.version, ",",
+          "empty poll", round(poll_time * 1e6, 2), "us")
+
+    publisher.close()
+
+@click.command()
+@click.option('--size', type=int, default=100000)
+@click.option('--versions', type=int, default=20000)
+def run(size, versions):
+    stress_test(size, versions)
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,374 @@
+import click
+import gym
+import math
+import numpy as np
+
+# Environments simulated with NumPy for many instances at once. A single
+# step() call advances the states of all the instances, which removes the
+# Python object and the step() call that gym pays for every instance.
+#
+# They follow the gym.vector interface: reset() and step() take and return
+# arrays with one row per instance, the finished instances are reset
+# automatically and their last observation is kept in the info under
+# "terminal_observation".
+
+# Shared by the instances that have nothing to report
+EMPTY_INFO = {}
+
+class VectorEnv:
+
+    # Set by the environments
+    ID = None
+    MAX_EPISODE_STEPS = None
+    STATE_SIZE = None
+
+    def __init__(self, num_envs, max_episode_steps=None, seed=None):
+
+        env = gym.make(self.ID)
+
+        self.num_envs = num_envs
+        self.single_observation_space = env.observation_space
+        self.single_action_space = env.action_space
+        self.max_episode_steps = max_episode_steps or self.MAX_EPISODE_STEPS
+
+        env.close()
+
+        self.np_random = np.random.RandomState(seed)
+
+        # One row per variable, the states are kept in float64 like gym
+        self.state = np.zeros((self.STATE_SIZE, num_envs))
+        self.steps = np.zeros(num_envs, dtype=int)
+
+    def seed(self, seed=None):
+        self.np_random = np.random.RandomState(seed)
+
+    def reset(self):
+
+        self.state[:] = self.initial_states(self.num_envs)
+        self.steps[:] = 0
+
+        return self.observations()
+
+    def observations(self):
+        return self.observe(self.state)
+
+    def observe(self, state):
+        return state.T.astype(np.float32)
+
+    def step(self, actions):
+
+        rewards, terminated = self.simulate(np.asarray(actions))
+
+        self.steps += 1
+
+        truncated = self.steps >= self.max_episode_steps
+        done = terminated | truncated
+
+        observations = self.observations()
+
+        infos = [EMPTY_INFO] * self.num_envs
+        finished = np.flatnonzero(done)
+
+        if len(finished):
+
+            # Copied before the observations of the new episodes overwrite them
+            terminal_observations = observations[finished]
+
+            for i, terminal_observation in zip(finished, terminal_observations):
+                infos[i] = {"terminal_observation": terminal_observation}
+                if not terminated[i]:
+                    infos[i]["TimeLimit.truncated"] = True
+
+            self.state[:, finished] = self.initial_states(len(finished))
+            self.steps[finished] = 0
+
+            observations[finished] = self.observe(self.state[:, finished])
+
+        return observations, rewards, done, infos
+
+    def close(self):
+        pass
+
+class CartPoleVectorEnv(VectorEnv):
+
+    ID = 'CartPole-v0'
+    MAX_EPISODE_STEPS = 200
+    STATE_SIZE = 4
+
+    # Same constants and dynamics as gym's CartPole
+    GRAVITY = 9.8
+    MASSCART = 1.0
+    MASSPOLE = 0.1
+    TOTAL_MASS = MASSPOLE + MASSCART
+    LENGTH = 0.5
+    POLEMASS_LENGTH = MASSPOLE * LENGTH
+    FORCE_MAG = 10.0
+    TAU = 0.02
+
+    THETA_THRESHOLD = 12 * 2 * math.pi / 360
+    X_THRESHOLD = 2.4
+
+    def initial_states(self, n):
+        return self.np_random.uniform(low=-0.05, high=0.05, size=(4, n))
+
+    def simulate(self, actions):
+
+        x, x_dot, theta, theta_dot = self.state
+
+        force = np.where(actions == 1, self.FORCE_MAG, -self.FORCE_MAG)
+        costheta = np.cos(theta)
+        sintheta = np.sin(theta)
+
+        temp = (force + self.POLEMASS_LENGTH * theta_dot ** 2 * sintheta) / self.TOTAL_MASS
+        thetaacc = (self.GRAVITY * sintheta - costheta * temp) / (
+            self.LENGTH * (4.0 / 3.0 - self.MASSPOLE * costheta ** 2 / self.TOTAL_MASS))
+        xacc = temp - self.POLEMASS_LENGTH * thetaacc * costheta / self.TOTAL_MASS
+
+        # Euler integration, the right hand sides use the previous state
+        self.state = np.stack((
+            x + self.TAU * x_dot,
+            x_dot + self.TAU * xacc,
+            theta + self.TAU * theta_dot,
+            theta_dot + self.TAU * thetaacc))
+
+        x, theta = self.state[0], self.state[2]
+
+        terminated = (x < -self.X_THRESHOLD) | (x > self.X_THRESHOLD) | \
+                     (theta < -self.THETA_THRESHOLD) | (theta > self.THETA_THRESHOLD)
+
+        # Every step is rewarded, the one that ends the episode included
+        return np.ones(self.num_envs), terminated
+
+class MountainCarVectorEnv(VectorEnv):
+
+    ID = 'MountainCar-v0'
+    MAX_EPISODE_STEPS = 200
+    STATE_SIZE = 2
+
+    # Same constants and dynamics as gym's MountainCar
+    MIN_POSITION = -1.2
+    MAX_POSITION = 0.6
+    MAX_SPEED = 0.07
+    GOAL_POSITION = 0.5
+    GOAL_VELOCITY = 0
+    FORCE = 0.001
+    GRAVITY = 0.0025
+
+    def initial_states(self, n):
+        return np.stack((self.np_random.uniform(low=-0.6, high=-0.4, size=n), np.zeros(n)))
+
+    def simulate(self, actions):
+
+        position, velocity = self.state
+
+        # The terms are summed before being added to the velocity as gym does
+        velocity = velocity + ((actions - 1) * self.FORCE + np.cos(3 * position) * (-self.GRAVITY))
+        velocity = np.clip(velocity, -self.MAX_SPEED, self.MAX_SPEED)
+        position = np.clip(position + velocity, self.MIN_POSITION, self.MAX_POSITION)
+
+        # The car stops against the left wall
+        velocity[(position == self.MIN_POSITION) & (velocity < 0)] = 0
+
+        self.state = np.stack((position, velocity))
+
+        terminated = (position >= self.GOAL_POSITION) & (velocity >= self.GOAL_VELOCITY)
+
+        return np.full(self.num_envs, -1.0), terminated
+
+class ContinuousMountainCarVectorEnv(MountainCarVectorEnv):
+
+    ID = 'MountainCarContinuous-v0'
+    MAX_EPISODE_STEPS = 999
+
+    GOAL_POSITION = 0.45
+    MIN_ACTION = -1.0
+    MAX_ACTION = 1.0
+    POWER = 0.0015
+
+    def simulate(self, actions):
+
+        position, velocity = self.state
+
+        actions = actions.reshape(self.num_envs).astype(np.float64)
+        force = np.clip(actions, self.MIN_ACTION, self.MAX_ACTION)
+
+        velocity = velocity + (force * self.POWER - 0.0025 * np.cos(3 * position))
+        velocity = np.clip(velocity, -self.MAX_SPEED, self.MAX_SPEED)
+        position = np.clip(position + velocity, self.MIN_POSITION, self.MAX_POSITION)
+
+        # The car stops against the left wall
+        velocity[(position == self.MIN_POSITION) & (velocity < 0)] = 0
+
+        # gym rounds the state to float32 after each step but computes the
+        # next one in float64
+        self.state = np.stack((position, velocity)).astype(np.float32).astype(np.float64)
+
+        terminated = (position >= self.GOAL_POSITION) & (velocity >= self.GOAL_VELOCITY)
+
+        # The goal is rewarded and the force is penalized
+        rewards = np.where(terminated, 100.0, 0.0) - actions ** 2 * 0.1
+
+        return rewards, terminated
+
+class PendulumVectorEnv(VectorEnv):
+
+    ID = 'Pendulum-v0'
+    MAX_EPISODE_STEPS = 200
+    STATE_SIZE = 2
+
+    # Same constants and dynamics as gym's Pendulum
+    MAX_SPEED = 8
+    MAX_TORQUE = 2.0
+    DT = 0.05
+    G = 10.0
+    M = 1.0
+    L = 1.0
+
+    def initial_states(self, n):
+        return np.stack((self.np_random.uniform(-np.pi, np.pi, n), self.np_random.uniform(-1, 1, n)))
+
+    def observe(self, state):
+
+        th, thdot = state
+        return np.stack((np.cos(th), np.sin(th), thdot), 1).astype(np.float32)
+
+    def simulate(self, actions):
+
+        th, thdot = self.state
+
+        # The torques are clipped in the precision of the actions
+        u = np.clip(actions, -self.MAX_TORQUE, self.MAX_TORQUE).reshape(self.num_envs).astype(np.float64)
+        costs = angle_normalize(th) ** 2 + 0.1 * thdot ** 2 + 0.001 * (u ** 2)
+
+        self.state = np.stack(self.integrate(th, thdot, u))
+
+        # A pendulum never falls, only the time limit ends the episodes
+        return -costs, np.zeros(self.num_envs, dtype=bool)
+
+    def integrate(self, th, thdot, u):
+
+        # Up to gym 0.21 the new angle uses the speed before it is clipped
+        newthdot = thdot + (-3 * self.G / (2 * self.L) * np.sin(th + np.pi) + 3. / (self.M * self.L ** 2) * u) * self.DT
+        newth = th + newthdot * self.DT
+        newthdot = np.clip(newthdot, -self.MAX_SPEED, self.MAX_SPEED)
+
+        return newth, newthdot
+
+class PendulumV1VectorEnv(PendulumVectorEnv):
+
+    ID = 'Pendulum-v1'
+
+    def integrate(self, th, thdot, u):
+
+        # Since gym 0.22 the speed is clipped before the new angle
+        newthdot = thdot + (3 * self.G / (2 * self.L) * np.sin(th) + 3.0 / (self.M * self.L ** 2) * u) * self.DT
+        newthdot = np.clip(newthdot, -self.MAX_SPEED, self.MAX_SPEED)
+        newth = th + newthdot * self.DT
+
+        return newth, newthdot
+
+class TerminalObservation(gym.Wrapper):
+
+    # gym.vector up to 0.21 resets the finished environments without keeping
+    # their last observation, its workers pass the info of step() through
+    # before the reset so the observation is added there
+    def step(self, action):
+
+        s, r, done, info = self.env.step(action)
+
+        if done:
+            info = dict(info, terminal_observation=s)
+
+        return s, r, done, info
+
+def angle_normalize(x):
+    return ((x + np.pi) % (2 * np.pi)) - np.pi
+
+VECTOR_ENVS = {env.ID: env for env in [
+    CartPoleVectorEnv,
+    MountainCarVectorEnv,
+    ContinuousMountainCarVectorEnv,
+    PendulumVectorEnv,
+    PendulumV1VectorEnv,
+]}
+
+def make(id, num_envs, asynchronous=False):
+
+    # The environments without a NumPy version, or asked to run in
+    # subprocesses, go through gym.vector
+    if asynchronous or id not in VECTOR_ENVS:
+        return gym.vector.make(id, num_envs=num_envs, asynchronous=asynchronous, wrappers=TerminalObservation)
+
+    return VECTOR_ENVS[id](num_envs)
+
+def final_observations(observations, done, infos):
+
+    # The observations that end the transitions of a step, the finished
+    # environments are already reset and their last observation is in the
+    # infos: under terminal_observation for the NumPy environments and
+    # gym.vector up to 0.23, under final_observation for gym.vector 0.24 and
+    # later, which returns a dict of arrays instead of a list of dicts
+    next_states = observations.copy()
+
+    for i in np.flatnonzero(done):
+
+        if isinstance(infos, dict) and "final_observation" in infos:
+            next_states[i] = infos["final_observation"][i]
+        elif not isinstance(infos, dict) and "terminal_observation" in infos[i]:
+            next_states[i] = infos[i]["terminal_observation"]
+        else:
+            raise RuntimeError("gym %s gave no last observation for a finished vector environment, "
+                               "make it with vector_envs.make" % gym.__version__)
+
+    return next_states
+
+def verify_env(id, num_envs, seed=0):
+
+    # Step the gym environments and the vectorized ones with the same actions
+    # from the same states until every gym environment is done once
+    envs = [gym.make(id) for i in range(num_envs)]
+    vector_env = VECTOR_ENVS[id](num_envs)
+    vector_env.reset()
+
+    for i, env in enumerate(envs):
+        env.seed(seed + i)
+        env.reset()
+        vector_env.state[:, i] = env.unwrapped.state
+
+    np.random.seed(seed)
+
+    running = np.ones(num_envs, dtype=bool)
+    error = 0.0
+    reward_error = 0.0
+    mismatches = 0
+    steps = 0
+
+    while running.any():
+
+        actions = np.array([envs[0].action_space.sample() for env in envs])
+        observations, rewards, done, infos = vector_env.step(actions)
+
+        for i in np.flatnonzero(running):
+
+            s, r, d, _ = envs[i].step(actions[i])
+            expected = infos[i]["terminal_observation"] if done[i] else observations[i]
+
+            error = max(error, np.abs(s - expected).max())
+            reward_error = max(reward_error, abs(r - rewards[i]))
+            mismatches += d != done[i]
+
+            running[i] = not d
+
+        steps += 1
+
+    print(id, num_envs, "environments,", steps, "steps,",
+          "max observation error", error, "max reward error", reward_error, "done mismatches", mismatches)
+
+@click.command()
+@click.argument('id')
+@click.option('--envs', type=int, default=100)
+def run(id, envs):
+    verify_env(id, envs)
+
+if __name__ == '__main__':
+    run()